@@ -0,0 +1,55 @@
+import zlib
+from typing import List, Optional
+
+try:
+    import zstandard  # optional, `pip install zstandard`
+except ImportError:
+    zstandard = None
+
+# HTTP content-codings this node can read, preferred first
+CODINGS: List[str] = (["zstd"] if zstandard is not None else []) + ["deflate"]
+
+
+def resolve(coding: str) -> Optional[str]:
+    """configured coding -> the one actually used: None for "none", deflate if zstd isn't installed"""
+    if coding == "none":
+        return None
+    if coding not in ("zstd", "deflate"):
+        raise ValueError(f"unknown compression {coding!r}, use zstd / deflate / none")
+    return coding if coding in CODINGS else "deflate"
+
+
+def compress(data: bytes, coding: str) -> bytes:
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 1)  # "deflate" is the zlib format in HTTP
+
+
+def decompress(data: bytes, coding: str) -> bytes:
+    """raises ValueError on an unknown coding or corrupted data"""
+    if coding not in CODINGS:
+        raise ValueError(f"unsupported content-coding {coding!r}")
+    try:
+        if coding == "zstd":
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+    except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+        raise ValueError(f"corrupted {coding} data: {e}")
+
+
+def pick(preferred: Optional[str], accept_encoding: str) -> Optional[str]:
+    """
+    the coding to send to a peer that advertised `accept_encoding` (Accept-Encoding syntax),
+    our configured one if the peer reads it, else deflate if both sides have it, else None
+    """
+    if preferred is None:
+        return None
+    theirs = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            theirs.add(name.strip().lower())
+    for coding in (preferred, "deflate"):
+        if coding in theirs and coding in CODINGS:
+            return coding
+    return None
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=timezone.utc)
+
+
+def ts_to_micros(ts: datetime) -> int:
+    """exact conversion (no float rounding), so dedup (entry equality) still holds after a restart"""
+    epoch = _EPOCH if ts.tzinfo is None else _EPOCH_UTC
+    return (ts - epoch) // timedelta(microseconds=1)
+
+
+def micros_to_ts(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+class Entry(NamedTuple):
+    """
+    Internal form of a log entry, what LogStore, the WAL, replication and snapshots pass around
+    a plain tuple - pydantic models (MessageOut, ReplicatePayload, ...) are only built at the API boundary
+    """
+
+    id: int
+    ts_us: int  # micros since epoch
+    content: str
+
+    @property
+    def ts(self) -> datetime:
+        return micros_to_ts(self.ts_us)
+
+    @classmethod
+    def from_message(cls, msg) -> "Entry":
+        """from anything with id / content / ts (ReplicatePayload)"""
+        return cls(msg.id, ts_to_micros(msg.ts), msg.content)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Entry":
+        return cls(data["id"], ts_to_micros(datetime.fromisoformat(data["ts"])), data["content"])
+
+    def to_json(self) -> dict:
+        """{id, content, ts as ISO 8601}, what the API has always returned"""
+        return {"id": self.id, "content": self.content, "ts": self.ts.isoformat()}
@@ -1,8 +1,10 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, constr
+
+from settings import settings
 
 
 class MessageIn(BaseModel):
@@ -12,12 +14,27 @@ class MessageIn(BaseModel):
         ge=1,
         description="Write concern: num of ACK required (1 = master only)",
     )
+    timeout_ms: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Write concern deadline, the write stays committed on master if it passes",
+    )
 
 
-class Message(BaseModel):
-    id: int = Field(ge=1)
-    content: str
-    ts: datetime
+class MessageBatchIn(BaseModel):
+    contents: List[constr(min_length=1)] = Field(  # type: ignore
+        ..., min_items=1, max_items=settings.messages_batch_max
+    )
+    w: int = Field(
+        default=1,
+        ge=1,
+        description="Write concern for the whole batch: num of ACK required (1 = master only)",
+    )
+    timeout_ms: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Write concern deadline, the batch stays committed on master if it passes",
+    )
 
 
 class MessageOut(BaseModel):
@@ -29,6 +46,14 @@ class MessageOut(BaseModel):
     content: str
 
 
+class MessageBatchOut(BaseModel):
+    """
+    response model for POST /messages/batch, ids assigned to the contents, in order
+    """
+
+    ids: List[int]
+
+
 class Ack(BaseModel):
     """
     Acknowledgement
@@ -51,12 +76,49 @@ class ReplicatePayload(BaseModel):
     ts: datetime
 
 
+class ReplicateBatch(BaseModel):
+    """
+    Ordered run of messages sent in one request, the secondary answers with one cumulative ACK
+    """
+
+    messages: List[ReplicatePayload] = Field(..., min_items=1)
+
+
+class DigestRequest(BaseModel):
+    """
+    Anti-entropy question from the master, all ranges are inclusive [lo, hi] and clipped to `upto`
+    ranges  -> one hash per range
+    entries -> the hash of every entry in each range (leaf level)
+    """
+
+    upto: int = Field(..., ge=0)
+    ranges: List[Tuple[int, int]] = []
+    entries: List[Tuple[int, int]] = []
+
+
+class ProgressRequest(BaseModel):
+    """
+    Upstream node's long-poll in a chain / tree: the subtree this node forwards to,
+    answered once the progress version differs from `version` (or after `wait_secs`)
+    """
+
+    downstream: List[dict] = []
+    version: Optional[int] = None
+    wait_secs: float = Field(default=10.0, ge=0, le=60)
+
+
 class SecondaryHealth(str, Enum):
     HEALTHY = "healthy"
     SUSPECTED = "suspected"
     UNHEALTHY = "unhealthy"
 
 
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
 class HealthResponse(BaseModel):
     ok: bool
     role: str
@@ -64,3 +126,8 @@ class HealthResponse(BaseModel):
     pending_out_of_order: int
     secondaries: Optional[dict] = None
     has_quorum: Optional[bool] = None
+    # progress report, the master seeds its replication state from it
+    last_id: Optional[int] = None
+    buffered_ids: Optional[List[int]] = None
+    incarnation: Optional[str] = None
+    topics: Optional[Dict[str, dict]] = None
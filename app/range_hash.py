@@ -0,0 +1,57 @@
+from hashlib import blake2b
+from typing import List
+
+from app.entry import Entry
+
+_MASK = (1 << 64) - 1
+
+
+def entry_hash(entry: Entry) -> int:
+    """64-bit hash of one log entry, id and ts included so equal contents at different ids differ"""
+    h = blake2b(digest_size=8)
+    h.update(entry.id.to_bytes(8, "little"))
+    h.update(entry.ts_us.to_bytes(8, "little", signed=True))
+    h.update(entry.content.encode())
+    return int.from_bytes(h.digest(), "little")
+
+
+class RangeHashIndex:
+    """
+    Hash tree over id ranges of a dense log, kept up to date on every commit
+
+    the hash of a range is the sum (mod 2^64) of its entry hashes, so a node of the tree
+    is just the sum of its children and no tree has to be materialized:
+    only the leaves (one sum per `leaf_size` consecutive ids) are stored,
+    any aligned range is a slice of them, and an overwrite is one subtraction + one addition
+
+    leaf k covers ids [k * leaf_size + 1, (k + 1) * leaf_size]
+    """
+
+    def __init__(self, leaf_size: int = 1024) -> None:
+        self.leaf_size = leaf_size
+        self._leaves: List[int] = []
+
+    def add(self, entry: Entry) -> None:
+        self._shift(entry.id, entry_hash(entry))
+
+    def remove(self, entry: Entry) -> None:
+        self._shift(entry.id, -entry_hash(entry))
+
+    def _shift(self, msg_id: int, delta: int) -> None:
+        leaf = (msg_id - 1) // self.leaf_size
+        if leaf >= len(self._leaves):
+            self._leaves.extend([0] * (leaf + 1 - len(self._leaves)))
+        self._leaves[leaf] = (self._leaves[leaf] + delta) & _MASK
+
+    def full_leaves(self, lo: int, hi: int) -> range:
+        """indices of the leaves that lie entirely inside [lo, hi]"""
+        first = -(-(lo - 1) // self.leaf_size)
+        last = hi // self.leaf_size - 1
+        return range(first, max(last + 1, first))
+
+    def leaves_sum(self, leaves: range) -> int:
+        return sum(self._leaves[leaves.start : leaves.stop]) & _MASK
+
+
+def combine(hashes) -> int:
+    return sum(hashes) & _MASK
@@ -1,35 +1,58 @@
 from fastapi import APIRouter
 
-from app.pydantic_models import HealthResponse
+from app.pydantic_models import BreakerState, HealthResponse
 from settings import settings
 
 router = APIRouter()
 
+# worst first, a secondary's breaker in /health is the worst one over the topics
+_BREAKER_ORDER = [BreakerState.OPEN, BreakerState.HALF_OPEN, BreakerState.CLOSED]
+
 
 @router.get("/health", response_model=HealthResponse)
 async def health():
-    from main import pending_buffer, store
-
-    message_count = len(await store.list_all())
-    pending_count = len(pending_buffer)
+    from app.topics import DEFAULT_TOPIC
+    from main import incarnation, topics
+
+    # per-topic progress, the master seeds its replication state from it
+    progress = {
+        name: {
+            "last_id": topic.store.last_id(),
+            "pending_out_of_order": topic.applier.pending_count,
+            **({"buffered_ids": topic.applier.buffered_ids} if settings.role == "secondary" else {}),
+        }
+        for name, topic in topics.items()
+    }
+    default = topics.get(DEFAULT_TOPIC)
 
     result = HealthResponse(
         ok=True,
         role=settings.role,
-        message_count=message_count,
-        pending_out_of_order=pending_count,
+        message_count=sum(len(topic.store) for topic in topics.values()),
+        pending_out_of_order=sum(topic.applier.pending_count for topic in topics.values()),
+        # the default log's progress stays at the top level for nodes from before topics
+        last_id=default.store.last_id() if default is not None else None,
+        incarnation=incarnation,
+        topics=progress,
     )
+    if settings.role == "secondary" and default is not None:
+        result.buffered_ids = default.applier.buffered_ids
 
     if settings.role == "master":
         from app.services.health_tracker import health_tracker
-        from app.services.replication_manager import replication_manager
 
         # verify how many messages are pending for the secondary (easy to track, considering the delay)
         secondaries_status = await health_tracker.get_all_status()
         for url in secondaries_status:
-            secondaries_status[url][
-                "pending_messages"
-            ] = await replication_manager.get_pending_count(url)
+            managers = [topic.replication_manager for topic in topics.values()]
+            secondaries_status[url]["pending_messages"] = sum(
+                [await manager.get_pending_count(url) for manager in managers]
+            )
+            secondaries_status[url]["breaker"] = min(
+                (manager.breaker_state(url) for manager in managers),
+                key=_BREAKER_ORDER.index,
+                default=BreakerState.CLOSED,
+            )
 
         result.secondaries = secondaries_status
         result.has_quorum = await health_tracker.has_quorum()
@@ -1,11 +1,14 @@
-import asyncio
+import json
 import logging
-from datetime import datetime
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
-from app.pydantic_models import Message, MessageIn, MessageOut
-from app.services.replication import replicate_one
+from app.pydantic_models import MessageBatchIn, MessageBatchOut, MessageIn, MessageOut
+from app.services.admission import admission
+from app.services.write_batcher import commit_and_replicate
+from app.topics import Topic, get_topic
 from settings import settings
 
 router = APIRouter()
@@ -13,26 +16,117 @@ log = logging.getLogger(settings.role.upper())
 
 
 @router.get("/messages", response_model=list[MessageOut])
-async def get_messages():
+async def get_messages(
+    response: Response,
+    topic: Topic = Depends(get_topic),
+    after: int = Query(
+        default=0, ge=0, description="Cursor: only messages with id > after"
+    ),
+    limit: Optional[int] = Query(
+        default=None,
+        ge=1,
+        le=settings.messages_page_max,
+        description="Max messages per page (all of them if omitted)",
+    ),
+):
     """
     GET messages is available at any role!
 
-    return: list of all messages
+    cursor pagination: pass the `X-Next-Cursor` header of the previous response as `after`,
+    pollers then only fetch what is new since their last call.
+    The body stays a plain list, so old clients (no params) keep getting the whole log
+
+    return: list of messages with id > after, in id order
+    """
+    messages = await topic.store.tail(after, limit)
+    # cursor for the next call: last returned id, or the same one if there is nothing new yet
+    response.headers["X-Next-Cursor"] = str(messages[-1].id if messages else after)
+    return [{"id": m.id, "content": m.content} for m in messages]
+
+
+@router.get("/messages/stream")
+async def stream_messages(
+    request: Request,
+    topic: Topic = Depends(get_topic),
+    after: int = Query(
+        default=0, ge=0, description="Cursor: only messages with id > after"
+    ),
+):
     """
-    from main import store
+    Server-Sent Events tail of the log, works on every role
 
-    return await store.list_all()
+    subscribers sleep on the store's commit notification and get only new entries, in id order.
+    Reconnecting clients may send `Last-Event-ID` instead of `after`
+    """
+    store = topic.store
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        after = max(after, int(last_event_id))
+
+    async def events():
+        cursor = after
+        while not await request.is_disconnected():
+            if not await store.wait_for_new(cursor, timeout=settings.stream_keepalive_secs):
+                yield ": keepalive\n\n"  # comment line, keeps proxies from closing the connection
+                continue
+            for msg in await store.tail(cursor, settings.messages_page_max):
+                data = json.dumps({"id": msg.id, "content": msg.content})
+                yield f"id: {msg.id}\ndata: {data}\n\n"
+                cursor = msg.id
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
 
 
 @router.post("/messages", response_model=MessageOut)
-async def append_message(payload: MessageIn):
+async def append_message(payload: MessageIn, topic: Topic = Depends(get_topic)):
     """
     Append a new message to the log (master only)
     Supports write concern for replication
     """
+    await check_writable(topic, payload.w)
+
+    with admission.waiter():
+        # 1) commit locally first (write-ahead), 2) start replication to every secondary
+        # with micro-batching enabled concurrent writers share both steps
+        if settings.write_batch_window_ms > 0:
+            msg = await topic.write_batcher.submit(payload.content)
+        else:
+            (msg,) = await commit_and_replicate(topic, [payload.content])
+
+        # 3) replication logic
+        await wait_for_write_concern(topic, payload.w, msg.id, msg.id, payload.timeout_ms)
+    return MessageOut(id=msg.id, content=msg.content)
+
+
+@router.post("/messages/batch", response_model=MessageBatchOut)
+async def append_messages(payload: MessageBatchIn, topic: Topic = Depends(get_topic)):
+    """
+    Append many messages at once (master only), one write concern for the whole batch
+
+    ids are reserved as one contiguous range, the run is committed and replicated as a single unit
+    """
+    await check_writable(topic, payload.w, len(payload.contents))
+
+    with admission.waiter():
+        msgs = await commit_and_replicate(topic, payload.contents)
+        await wait_for_write_concern(
+            topic, payload.w, msgs[0].id, msgs[-1].id, payload.timeout_ms
+        )
+    return MessageBatchOut(ids=[m.id for m in msgs])
+
+
+async def check_writable(topic: Topic, write_concern: int, count: int = 1) -> None:
+    """
+    master only, quorum present, w not above the number of nodes or the reachable ones,
+    and the master isn't overloaded (admission control, 429 + Retry-After)
+
+    no awaits after the admission check, so the caller takes its waiter slot right after it
+    """
     from app.services.health_tracker import health_tracker
-    from main import store
 
+    replication_manager = topic.replication_manager
     if settings.role != "master":
         raise HTTPException(status_code=405, detail="POST only allowed on master")
 
@@ -41,7 +135,6 @@ async def append_message(payload: MessageIn):
             status_code=503, detail="No quorum. Master is in read-only mode"
         )
 
-    write_concern = payload.w
     num_secondaries = len(settings.secondaries)
 
     # validate write concern (master + secondaries)
@@ -52,46 +145,78 @@ async def append_message(payload: MessageIn):
             detail=f"Write concern w={write_concern} exceeds available nodes ({max_w}) ",
         )
 
-    # 1) reserve id and create message
-    msg_id = await store.reserve_id()
-    msg = Message(
-        id=msg_id, content=payload.content, ts=datetime.now()
-    )  # .now == utcnow()
+    # fail fast: don't commit a write whose w can't be met with the open circuit breakers
+    available = 1 + replication_manager.available_count()
+    if write_concern > available:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Write concern w={write_concern} unreachable, only {available} node(s) available",
+        )
+
+    # no backlog drains enough for this one, a 429 would have the client retry forever
+    if 0 < settings.admission_max_lag < count:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {count} messages exceeds ADMISSION_MAX_LAG ({settings.admission_max_lag}), split it",
+        )
 
-    # 2) write locally first (write-ahead)
-    await store.commit(msg)
-    log.info(
-        f"Committed locally id={msg.id} content_length={len(msg.content)} ts={msg.ts.isoformat()}"
-    )
+    retry_after = admission.retry_after(replication_manager)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Master is overloaded, replication is lagging behind",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+async def wait_for_write_concern(
+    topic: Topic,
+    write_concern: int,
+    first_id: int,
+    last_id: int,
+    timeout_ms: Optional[int] = None,
+) -> None:
+    """
+    returns once w-1 secondaries ACK'ed the whole [first_id, last_id] run
+
+    503 when too many secondaries became unreachable (circuit breaker opened) meanwhile,
+    504 when `timeout_ms` passed first. Either way the run stays committed on master
+    and keeps replicating in the background
+    """
+    replication_manager = topic.replication_manager
+
+    label = f"id={first_id}" if first_id == last_id else f"ids={first_id}..{last_id}"
 
-    # 3) replication logic
     # required_acks = w - 1
     required_acks = write_concern - 1
 
-    # start all replication tasks concurrently
-    tasks = [
-        asyncio.create_task(replicate_one(str(url), msg))
-        for url in settings.secondaries
-    ]
-
-    # w=1: return immediately after master commit (fire-and-forget replication)
+    # w=1: return immediately after master commit (replication continues in the background)
     if required_acks == 0:
-        log.info(f"w=1 satisfied: master commit for id={msg.id}")
-        return msg
-
-    # w>1: wait for required secondary ACKs
-    acks = 0
-    for coro in asyncio.as_completed(tasks):
-        if await coro:
-            acks += 1
-            if acks >= required_acks:
-                log.info(f"w={write_concern} satisfied: {acks} ACKs for id={msg.id}")
-                return msg
-
-    log.error(
-        f"w={write_concern} failed: got {acks}/{required_acks} ACKs for id={msg.id}"
+        log.info(f"w=1 satisfied: master commit for {label}")
+        return
+
+    if timeout_ms is None:
+        timeout_ms = settings.write_concern_timeout_ms
+    timeout = None if timeout_ms is None else timeout_ms / 1000
+
+    # w>1: wait for required secondary ACKs, the replication workers keep retrying meanwhile
+    acks, reachable = await replication_manager.wait_for_acks(
+        first_id, last_id, required_acks, timeout
     )
+    if acks >= required_acks:
+        log.info(f"w={write_concern} satisfied: {acks} ACKs for {label}")
+        return
+
+    if reachable < required_acks:
+        log.warning(f"w={write_concern} unreachable: {acks} ACKs for {label}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Write concern w={write_concern} unreachable, got {acks} ACKs "
+            f"(committed on master, replication continues)",
+        )
+    log.warning(f"w={write_concern} timed out: {acks} ACKs for {label}")
     raise HTTPException(
-        status_code=502,
-        detail=f"Replication failed: got {acks}/{required_acks} secondary ACKs",
+        status_code=504,
+        detail=f"Write concern w={write_concern} timed out after {timeout_ms}ms, got {acks} ACKs "
+        f"(committed on master, replication continues)",
     )
@@ -1,88 +1,284 @@
 import asyncio
+import json
 import logging
+from collections import defaultdict
+from typing import Dict, List
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import ValidationError
 
-from app.pydantic_models import Message, ReplicatePayload
+from app import compression, wire
+from app.entry import Entry
+from app.pydantic_models import DigestRequest, ProgressRequest, ReplicateBatch, ReplicatePayload
+from app.services.applier import ApplyConflict
+from app.snapshot import read_chunks
+from app.topics import Topic, get_topic
 from settings import settings
 
-router = APIRouter()
 log = logging.getLogger(settings.role.upper())
 
 
+def advertise_codings(response: Response):
+    """tell the master which request content-codings this node reads (RFC 7694)"""
+    response.headers["Accept-Encoding"] = ", ".join(compression.CODINGS)
+
+
+router = APIRouter(dependencies=[Depends(advertise_codings)])
+
+# one snapshot load at a time, per topic
+_snapshot_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
 @router.post("/replicate", include_in_schema=False)
-async def receive_replication(msg: ReplicatePayload):
+async def receive_replication(request: Request, topic: Topic = Depends(get_topic)):
     """
     Internal endpoint for receiving replicated messages from master
     Implements deduplication and total ordering
+    body: a ReplicatePayload, or a single message in the binary wire format
     """
 
-    from main import pending_buffer, store
-
     if settings.role == "master":
         raise HTTPException(
             status_code=405, detail="replicate endpoint only for secondaries"
         )
 
+    (msg,) = await read_entries(request, single=True)
+
     # simulate artificial delay to demonstrate eventual consistency
     if settings.repl_delay_secs > 0:
         log.info(f"Simulating delay of {settings.repl_delay_secs}s for msg id={msg.id}")
         await asyncio.sleep(settings.repl_delay_secs)
 
-    # convert to Message obj for storage
-    incoming_msg = Message(id=msg.id, content=msg.content, ts=msg.ts)
+    (status,) = await apply_replicated(topic, [msg])
+    result = {"status": "ok", "id": msg.id}
+    if status != "committed":
+        result[status] = True  # "dedup" / "buffered", same flags as before
+    return result
+
+
+@router.post("/replicate/batch", include_in_schema=False)
+async def receive_replication_batch(request: Request, topic: Topic = Depends(get_topic)):
+    """
+    Same as /replicate, but for an ordered run of messages
+    the artificial delay is paid once per batch and a single cumulative ACK is returned:
+    every id up to `last_id` is either committed, a duplicate or buffered
+    body: a ReplicateBatch, or the binary wire format (app/wire.py)
+    """
+    from main import incarnation
+
+    if settings.role == "master":
+        raise HTTPException(
+            status_code=405, detail="replicate endpoint only for secondaries"
+        )
+
+    msgs = await read_entries(request)
+    first_id, last_id = msgs[0].id, msgs[-1].id
+    if settings.repl_delay_secs > 0:
+        log.info(
+            f"Simulating delay of {settings.repl_delay_secs}s for batch ids={first_id}..{last_id}"
+        )
+        await asyncio.sleep(settings.repl_delay_secs)
+
+    # a conflict in the middle aborts the rest, everything before it is already applied
+    await apply_replicated(topic, msgs)
+
+    return {
+        "status": "ok",
+        "first_id": first_id,
+        "last_id": last_id,
+        "count": len(msgs),
+        # contiguous prefix committed on this node, buffered messages are above it
+        "committed_through": topic.store.last_id(),
+        "incarnation": incarnation,
+    }
+
+
+@router.get("/replicate/range", include_in_schema=False)
+async def replication_range(
+    request: Request,
+    topic: Topic = Depends(get_topic),
+    start: int = Query(..., ge=1),
+    end: int = Query(..., ge=1, description="exclusive"),
+):
+    """
+    range read for pull catch-up: messages start <= id < end with their original ts,
+    at most `messages_page_max` of them, in the binary wire format if the Accept header asks for it
+    """
+    msgs = await topic.store.range(start, min(end, start + settings.messages_page_max))
+    if wire.accepts(request.headers.get("accept", "")):
+        body, media_type = wire.encode(msgs), wire.MEDIA_TYPE
+    else:
+        body, media_type = json.dumps([e.to_json() for e in msgs]).encode(), "application/json"
+
+    headers = {}
+    coding = compression.pick(
+        compression.resolve(settings.repl_compression), request.headers.get("accept-encoding", "")
+    )
+    if coding is not None and len(body) >= settings.repl_compression_min_bytes:
+        body = compression.compress(body, coding)
+        headers["Content-Encoding"] = coding
+    return Response(body, media_type=media_type, headers=headers)
+
 
-    # DEDUPLICATION: Check if we already have this message
-    existing = await store.get_by_id(msg.id)
-    if existing is not None:
-        if existing.content == msg.content and existing.ts == msg.ts:
-            log.info(f"Dedup: message id={msg.id} already exists, returning OK")
-            return {"status": "ok", "id": msg.id, "dedup": True}
-        # same ID but different content - conflict
+@router.post("/replicate/digest", include_in_schema=False)
+async def replication_digest(req: DigestRequest, topic: Topic = Depends(get_topic)):
+    """
+    range hashes of this node's log for anti-entropy, a few bytes per range instead of the entries
+    everything is clipped to min(upto, last_id), the used bound is returned as `last_id`
+    """
+    store = topic.store
+    upto = min(req.upto, store.last_id())
+    return {
+        "last_id": upto,
+        "hashes": [await store.range_hash(lo, min(hi, upto)) for lo, hi in req.ranges],
+        "entries": [await store.entry_hashes(lo, min(hi, upto)) for lo, hi in req.entries],
+    }
+
+
+@router.post("/replicate/repair", include_in_schema=False)
+async def receive_repair(request: Request, topic: Topic = Depends(get_topic)):
+    """
+    anti-entropy repair from master: its version of entries that differ here wins,
+    unlike /replicate this overwrites instead of answering 409
+    """
+    if settings.role == "master":
         raise HTTPException(
-            status_code=409,
-            detail=f"Conflict: message id={msg.id} exists with different content",
+            status_code=405, detail="replicate endpoint only for secondaries"
         )
 
-    # TOTAL ORDERING: only accept messages in sequence
-    expected_id = await store.reserve_id()
+    repaired = 0
+    for msg in await read_entries(request):
+        if await topic.store.overwrite(msg):
+            log.warning(f"Repaired divergent message id={msg.id}")
+            repaired += 1
+    return {"status": "ok", "repaired": repaired}
 
-    if msg.id == expected_id:
-        # this is the next expected message - commit it
-        await store.commit(incoming_msg)
-        log.info(f"Committed id={msg.id} (expected={expected_id})")
 
-        # check if any buffered messages can now be committed
-        await flush_pending_buffer()
+@router.post("/replicate/progress", include_in_schema=False)
+async def replication_progress(req: ProgressRequest, topic: Topic = Depends(get_topic)):
+    """
+    chain / tree replication: the upstream node hands this one the subtree it forwards to,
+    and long-polls the progress of this node + everything below it (ACKs flow back up).
+    Answers as soon as anything moved since `version`, or after `wait_secs`
+    """
+    from main import incarnation
 
-        return {"status": "ok", "id": msg.id}
+    replication_manager = topic.replication_manager
 
-    elif msg.id > expected_id:
-        # out of order - buffer for later
-        pending_buffer[msg.id] = incoming_msg
-        log.warning(
-            f"Out-of-order: got id={msg.id}, expected={expected_id}. goes to buffer bye-bye"
+    if settings.role == "master":
+        raise HTTPException(
+            status_code=405, detail="replicate endpoint only for secondaries"
         )
-        return {"status": "ok", "id": msg.id, "buffered": True}
 
-    else:
-        # msg.id < expected_id means we already processed this or there's a gap issue
-        # This shouldn't happen with proper dedup, but handle defensively
+    replication_manager.set_downstream(req.downstream)
+    version = await replication_manager.wait_for_progress(req.version, req.wait_secs)
+    return {
+        "version": version,
+        "self": {"incarnation": incarnation, "committed_through": topic.store.last_id()},
+        "progress": replication_manager.report(),
+    }
+
+
+@router.post("/snapshot", include_in_schema=False)
+async def receive_snapshot(request: Request, topic: Topic = Depends(get_topic)):
+    """
+    bootstrap from a snapshot streamed by the master (see app/snapshot.py),
+    chunks are verified and bulk-loaded as they arrive, through the applier like any other push.
+    Entries this node already has are skipped, afterwards the master continues
+    with regular replication from the returned `last_id`
+    """
+    from main import incarnation
+
+    store, snapshot_lock = topic.store, _snapshot_locks[topic.name]
+    if settings.role == "master":
         raise HTTPException(
-            status_code=409, detail=f"Unexpected id={msg.id}, expected >= {expected_id}"
+            status_code=405, detail="snapshot endpoint only for secondaries"
         )
+    if snapshot_lock.locked():
+        raise HTTPException(status_code=409, detail="Snapshot already in progress")
+
+    loaded = 0
+    async with snapshot_lock:
+        try:
+            async for msgs in read_chunks(request.stream()):
+                msgs = [m for m in msgs if m.id > store.last_id()]
+                if not msgs:
+                    continue
+                if msgs[0].id != store.last_id() + 1:
+                    # where this node really is, the sender may still hold a wiped incarnation's watermark
+                    raise HTTPException(
+                        status_code=409,
+                        detail={
+                            "error": f"Snapshot gap: got id={msgs[0].id}, expected {store.last_id() + 1}",
+                            "last_id": store.last_id(),
+                            "incarnation": incarnation,
+                        },
+                    )
+                await topic.applier.submit(msgs)
+                loaded += len(msgs)
+        except ApplyConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Corrupted snapshot: {e}")
+
+    log.info(f"Loaded snapshot: {loaded} messages, now at id={store.last_id()}")
+    return {
+        "status": "ok",
+        "count": loaded,
+        "last_id": store.last_id(),
+        "incarnation": incarnation,
+    }
 
 
-async def flush_pending_buffer() -> None:
-    """commit pending messages that are now in sequence"""
+async def read_entries(request: Request, single: bool = False) -> List[Entry]:
+    """
+    body of a replication request by its Content-Type: the binary wire format
+    goes straight to Entry, JSON is validated as before (ReplicatePayload / ReplicateBatch).
+    Compressed bodies (Content-Encoding) are inflated first
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body = await request.body()
+
+    coding = request.headers.get("content-encoding", "identity").strip().lower()
+    if coding != "identity":
+        if coding not in compression.CODINGS:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Unsupported Content-Encoding {coding}",
+                headers={"Accept-Encoding": ", ".join(compression.CODINGS)},
+            )
+        try:
+            body = compression.decompress(body, coding)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if content_type == wire.MEDIA_TYPE:
+        try:
+            msgs = wire.decode(body)
+        except ValueError as e:  # UnicodeDecodeError included
+            raise HTTPException(status_code=400, detail=f"Malformed batch: {e}")
+        if not msgs or (single and len(msgs) != 1):
+            raise HTTPException(
+                status_code=400, detail=f"Unexpected message count {len(msgs)}"
+            )
+        return msgs
+
+    if content_type not in ("application/json", ""):
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported Content-Type, use application/json or {wire.MEDIA_TYPE}",
+        )
+    try:
+        if single:
+            return [Entry.from_message(ReplicatePayload.parse_raw(body))]
+        return [Entry.from_message(m) for m in ReplicateBatch.parse_raw(body).messages]
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
 
-    from main import pending_buffer, store
 
-    while True:
-        next_expected = await store.reserve_id()
-        if next_expected in pending_buffer:
-            msg = pending_buffer.pop(next_expected)
-            await store.commit(msg)
-            log.info(f"Flushed buffered message id={msg.id}")
-        else:
-            break
+async def apply_replicated(topic: Topic, msgs: List[Entry]) -> List[str]:
+    """dedup + total ordering, done by the topic's single applier task (see app/services/applier.py)"""
+    try:
+        return await topic.applier.submit(msgs)
+    except ApplyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
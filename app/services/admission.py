@@ -0,0 +1,82 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from app.pydantic_models import BreakerState
+from settings import settings
+
+log = logging.getLogger("ADMISSION")
+
+# weight of the newest write-concern wait in the average
+_WAIT_EWMA_ALPHA = 0.2
+
+
+class AdmissionController:
+    """
+    Backpressure for the master write path, a write is rejected (429 + Retry-After) when
+    - `admission_max_waiters` writes are still outstanding (committing / waiting for their write concern), or
+    - a reachable secondary (breaker not OPEN) is already `admission_max_lag` messages behind
+
+    secondaries with an OPEN breaker don't count, writes needing them fail fast anyway
+    and w=1 writes keep working while one of them is down.
+    Retry-After is an estimate: how long the backlog needs to drain at the secondary's
+    recent ACK rate, or the average write-concern wait when there are too many waiters
+    """
+
+    def __init__(self):
+        self._waiters = 0
+        self._avg_wait_secs = 0.0
+
+    @property
+    def waiters(self) -> int:
+        return self._waiters
+
+    def retry_after(self, replication_manager) -> Optional[int]:
+        """
+        seconds the client should back off for, None if the write may go through
+        waiters are counted per process, the lag per topic (the manager of the one written to)
+        """
+        if 0 < settings.admission_max_waiters <= self._waiters:
+            log.warning(f"Rejecting write: {self._waiters} writes still outstanding")
+            return self._clamp(self._avg_wait_secs)
+
+        if settings.admission_max_lag > 0:
+            worst = None
+            for url in map(str, settings.secondaries):
+                if replication_manager.breaker_state(url) == BreakerState.OPEN:
+                    continue
+                # only the existing backlog counts, a batch is never too big to ever get in
+                excess = replication_manager.lag(url) - settings.admission_max_lag + 1
+                if excess <= 0:
+                    continue
+                rate = replication_manager.drain_rate(url)
+                wait = excess / rate if rate > 0 else settings.admission_retry_after_max_secs
+                log.warning(f"Rejecting write: {url} is {excess} messages over the lag limit")
+                worst = wait if worst is None else max(worst, wait)
+            if worst is not None:
+                return self._clamp(worst)
+
+        return None
+
+    @contextmanager
+    def waiter(self):
+        """hold a write-concern waiter slot for the duration of the block"""
+        self._waiters += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._waiters -= 1
+            waited = time.monotonic() - started
+            self._avg_wait_secs += _WAIT_EWMA_ALPHA * (waited - self._avg_wait_secs)
+
+    @staticmethod
+    def _clamp(secs: float) -> int:
+        # Retry-After is whole seconds
+        return min(max(math.ceil(secs), 1), math.ceil(settings.admission_retry_after_max_secs))
+
+
+# module-level instance acts as a singleton, same as the other services
+admission = AdmissionController()
@@ -0,0 +1,51 @@
+import time
+from typing import Optional
+
+from app.pydantic_models import BreakerState
+
+
+class CircuitBreaker:
+    """
+    Per-secondary breaker, decides whether that secondary can count towards a write concern right now
+
+    CLOSED    - normal operation
+    OPEN      - too many replication errors in a row, or the HealthTracker says UNHEALTHY,
+                writes needing this secondary fail fast instead of hanging
+    HALF_OPEN - `reset_secs` passed since opening, one trial batch may go through,
+                success closes the breaker, failure opens it again
+    """
+
+    def __init__(self, failure_threshold: int, reset_secs: float) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_secs = reset_secs
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> BreakerState:
+        if self._opened_at is None:
+            return BreakerState.CLOSED
+        if time.monotonic() - self._opened_at < self._reset_secs:
+            return BreakerState.OPEN
+        return BreakerState.HALF_OPEN
+
+    def retry_in(self) -> float:
+        """seconds until an OPEN breaker lets a trial through"""
+        if self._opened_at is None:
+            return 0.0
+        return max(self._opened_at + self._reset_secs - time.monotonic(), 0.0)
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if (
+            self._failures >= self._failure_threshold
+            or self.state == BreakerState.HALF_OPEN
+        ):
+            self.trip()
+
+    def trip(self) -> None:
+        self._opened_at = time.monotonic()
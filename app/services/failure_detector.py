@@ -0,0 +1,93 @@
+import math
+import time
+from collections import deque
+from typing import Optional
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.), one per secondary
+
+    instead of a yes/no after N missed beats it learns the distribution of heartbeat
+    inter-arrival times (mean + std over a sliding window) and outputs a suspicion level:
+        phi = -log10(P(next heartbeat arrives later than now))
+    phi = 1 ~ 10% chance we're wrong to suspect, phi = 3 ~ 0.1%, phi = 8 ~ 1e-8
+
+    so a link that normally answers every 1s is suspected quickly, a jittery one gets more slack.
+    Probe latencies are tracked the same way, the tracker uses them for adaptive probe timeouts
+    """
+
+    def __init__(
+        self,
+        expected_interval: float,
+        window: int = 100,
+        min_std: float = 0.1,
+        pause: float = 0.0,
+    ) -> None:
+        self._intervals: deque = deque(maxlen=window)
+        self._latencies: deque = deque(maxlen=window)
+        self._min_std = min_std
+        self._pause = pause  # acceptable extra pause on top of the mean (e.g. the probe timeout)
+        self._last: Optional[float] = None
+        # bootstrap with the configured interval, until real samples come in
+        self._intervals.append(expected_interval)
+        self._intervals.append(expected_interval * 1.5)
+        self._intervals.append(expected_interval * 0.5)
+
+    @property
+    def last_arrival(self) -> Optional[float]:
+        return self._last
+
+    def heartbeat(self, latency: Optional[float] = None, now: Optional[float] = None) -> None:
+        """
+        record an arrival (a successful probe or any replication ACK)
+
+        arrivals closer than half the mean interval only move `last_arrival`, bursts of ACKs
+        on a busy link would otherwise teach the detector to panic as soon as traffic stops
+        """
+        now = time.monotonic() if now is None else now
+        if self._last is not None:
+            interval = now - self._last
+            if interval >= self._mean(self._intervals) / 2:
+                self._intervals.append(interval)
+        self._last = now
+        if latency is not None:
+            self._latencies.append(latency)
+
+    def phi(self, now: Optional[float] = None) -> float:
+        if self._last is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        mean = self._mean(self._intervals) + self._pause
+        std = max(self._std(self._intervals), self._min_std)
+        return _phi(now - self._last, mean, std)
+
+    def latency_bound(self, default: float) -> float:
+        """mean + 4 std of the probe latency, `default` until there are a few samples"""
+        if len(self._latencies) < 3:
+            return default
+        return self._mean(self._latencies) + 4 * max(
+            self._std(self._latencies), self._min_std / 10
+        )
+
+    @staticmethod
+    def _mean(samples: deque) -> float:
+        return sum(samples) / len(samples)
+
+    @classmethod
+    def _std(cls, samples: deque) -> float:
+        mean = cls._mean(samples)
+        return math.sqrt(sum((s - mean) ** 2 for s in samples) / len(samples))
+
+
+def _phi(elapsed: float, mean: float, std: float) -> float:
+    # logistic approximation of the normal CDF tail (same one Akka / Cassandra use),
+    # P(later) = 1 / (1 + exp(-x)), evaluated on the side that can't overflow
+    y = (elapsed - mean) / std
+    x = -y * (1.5976 + 0.070566 * y * y)
+    if x >= 0:
+        p_later = 1.0 / (1.0 + math.exp(-x))
+    else:
+        e = math.exp(x)
+        p_later = e / (1.0 + e)
+    return -math.log10(max(p_later, 1e-300))
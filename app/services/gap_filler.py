@@ -0,0 +1,72 @@
+import asyncio
+from typing import List
+
+from app import wire
+from app.entry import Entry
+from app.services.applier import ApplyConflict
+from app.services.transport import transport
+from settings import settings
+
+
+class GapFiller:
+    """
+    Secondary side pull catch-up: when messages sit in the pending buffer because an earlier
+    range never arrived, and that gap is still there after `gap_pull_delay_ms`,
+    the missing range is read from the master (GET /replicate/range) instead of waiting
+    for the master's worker to retry the push. The buffer is drained right after
+
+    short out-of-order windows (several batches in flight) close on their own before the delay
+    """
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.log = topic.logger("GAP_FILLER")
+        self._task = None
+
+    def notice(self):
+        """called whenever something was buffered out of order"""
+        if settings.role != "secondary" or settings.master_url is None:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        applier, store = self.topic.applier, self.topic.store
+        delay = settings.gap_pull_delay_ms / 1000
+        while applier.pending_count:
+            await asyncio.sleep(delay)
+            delay = settings.gap_pull_delay_ms / 1000
+            first_pending = applier.first_pending()
+            start = store.last_id() + 1
+            if first_pending is None or first_pending <= start:
+                continue  # closed meanwhile, or about to be drained by the applier
+
+            end = min(first_pending, start + settings.messages_page_max)
+            try:
+                msgs = await self._fetch(start, end)
+            except Exception as e:
+                self.log.warning(f"Pulling ids={start}..{end - 1} from master failed: {e}")
+                continue
+
+            msgs = [m for m in msgs if m.id > store.last_id()]
+            if not msgs:
+                continue
+            try:
+                await applier.submit(msgs)
+            except ApplyConflict as e:
+                self.log.warning(f"Pulled gap conflicts with this node's log: {e}")
+                continue
+            self.log.info(f"Pulled gap ids={msgs[0].id}..{msgs[-1].id} from master")
+            delay = 0  # made progress, look at the next gap right away
+
+    async def _fetch(self, start: int, end: int) -> List[Entry]:
+        url = str(settings.master_url)
+        r = await transport.client(url).get(
+            url.rstrip("/") + self.topic.path("/replicate/range"),
+            params={"start": start, "end": end},
+            headers={"Accept": f"{wire.MEDIA_TYPE}, application/json;q=0.5"},
+        )
+        r.raise_for_status()
+        if r.headers.get("content-type", "").startswith(wire.MEDIA_TYPE):
+            return wire.decode(r.content)
+        return [Entry.from_json(m) for m in r.json()]
@@ -1,21 +1,37 @@
 import asyncio
 import logging
+import time
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Optional
 
 import httpx
 
 from app.pydantic_models import SecondaryHealth
+from app.services.failure_detector import PhiAccrualDetector
+from app.services.transport import transport
 from settings import settings
 
 log = logging.getLogger("HEALTH_TRACKER")
 
 
 class HealthTracker:
+    """
+    Heartbeats to every secondary, fanned out concurrently: each secondary has at most one
+    probe in flight, a dead node (waiting out its timeout) doesn't delay the others
+
+    the state comes from a PhiAccrualDetector per secondary, learned from that secondary's own
+    heartbeat intervals - SUSPECTED / UNHEALTHY once phi crosses the configured thresholds.
+    The old missed-beat counts stay as a hard upper bound.
+    Replication ACKs count as heartbeats too, a secondary heard from within the last
+    interval isn't probed at all, so busy links carry no extra heartbeat traffic
+    """
+
     def __init__(self):
         self._status: Dict[str, SecondaryHealth] = {}
         self._missed_beats: Dict[str, int] = {}
         self._last_seen: Dict[str, datetime] = {}
+        self._detectors: Dict[str, PhiAccrualDetector] = {}
+        self._probes: Dict[str, asyncio.Task] = {}
         self._lock = asyncio.Lock()
         self._running = False
 
@@ -24,11 +40,27 @@ class HealthTracker:
             self._status[url_str] = SecondaryHealth.HEALTHY
             self._missed_beats[url_str] = 0
             self._last_seen[url_str] = datetime.now()
+            self._detectors[url_str] = PhiAccrualDetector(
+                settings.heartbeat_interval_secs,
+                window=settings.phi_window,
+                min_std=settings.phi_min_std_secs,
+                # a probe may take up to its timeout before it counts as an arrival
+                pause=settings.heartbeat_timeout_secs,
+            )
+            # until the first arrival, measure from startup
+            self._detectors[url_str].heartbeat()
 
     async def start(self):
         if settings.role != "master" or self._running:
             return
         self._running = True
+        # one round right away: the secondaries' progress reports seed the replication
+        # manager before its workers start, so a restarted master doesn't replay the log.
+        # Startup waits at most one heartbeat timeout for it, a slow digest keeps going in the
+        # background and seeds the window when it's done
+        probes = [self._start_probe(str(url)) for url in settings.secondaries]
+        if probes:
+            await asyncio.wait(probes, timeout=settings.heartbeat_timeout_secs)
         asyncio.create_task(self._heartbeat_loop())
         log.info("Heartbeat tracker started")
 
@@ -38,40 +70,99 @@ class HealthTracker:
             await self._check_all_secondaries()
 
     async def _check_all_secondaries(self):
-        timeout = httpx.Timeout(settings.heartbeat_timeout_secs)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            for url in settings.secondaries:
-                url_str = str(url)
-                target = url_str.rstrip("/") + "/health"
-                try:
-                    r = await client.get(target)
-                    r.raise_for_status()
-                    await self._mark_healthy(url_str)
-                except Exception as e:
-                    await self._mark_missed(url_str)
-                    log.debug(f"Heartbeat failed for {url_str}: {e}")
-
-    async def _mark_healthy(self, url: str):
+        now = time.monotonic()
+        for url in map(str, settings.secondaries):
+            probe = self._probes.get(url)
+            if probe is not None and not probe.done():
+                continue  # previous one still waiting for its timeout
+            last = self._detectors[url].last_arrival
+            if last is not None and now - last < settings.heartbeat_interval_secs:
+                continue  # heard from it recently (replication ACK), no need to ask
+            self._start_probe(url)
+
+        # the suspicion level grows while nothing arrives, even with a probe still hanging
+        await asyncio.gather(*(self._evaluate(str(url)) for url in settings.secondaries))
+
+    def _start_probe(self, url: str) -> asyncio.Task:
+        self._probes[url] = asyncio.create_task(self._probe(url))
+        return self._probes[url]
+
+    async def _probe(self, url: str):
+        detector = self._detectors[url]
+        target = url.rstrip("/") + "/health"
+        # adaptive timeout from the observed probe latency, never above the configured one
+        timeout = min(
+            detector.latency_bound(settings.heartbeat_timeout_secs),
+            settings.heartbeat_timeout_secs,
+        )
+        from app.topics import DEFAULT_TOPIC
+        from main import topics
+
+        started = time.monotonic()
+        try:
+            r = await transport.client(url).get(target, timeout=httpx.Timeout(timeout))
+            r.raise_for_status()
+            report = r.json()
+        except Exception as e:
+            log.debug(f"Heartbeat failed for {url}: {e}")
+            async with self._lock:
+                self._missed_beats[url] += 1
+            await self._evaluate(url)
+            return
+        await self._mark_healthy(url, latency=time.monotonic() - started)
+
+        # per-topic progress, nodes from before topics only report the default log
+        progress = report.get("topics") or {}
+        if not progress and report.get("last_id") is not None:
+            progress = {DEFAULT_TOPIC: report}
+        for name, topic_report in progress.items():
+            if name in topics and topic_report.get("last_id") is not None:
+                await topics[name].replication_manager.seed_progress(
+                    url,
+                    report.get("incarnation"),
+                    topic_report["last_id"],
+                    topic_report.get("buffered_ids") or (),
+                )
+
+    async def _mark_healthy(self, url: str, latency: Optional[float] = None):
+        from main import topics
+
         async with self._lock:
+            self._detectors[url].heartbeat(latency)
             self._missed_beats[url] = 0
             self._last_seen[url] = datetime.now()
-            if self._status[url] != SecondaryHealth.HEALTHY:
+            recovered = self._status[url] != SecondaryHealth.HEALTHY
+            if recovered:
                 log.info(f"{url} is now HEALTHY")
             self._status[url] = SecondaryHealth.HEALTHY
 
-    async def _mark_missed(self, url: str):
+        if recovered:
+            for topic in topics.values():
+                topic.replication_manager.on_health_change(url, SecondaryHealth.HEALTHY)
+
+    async def _evaluate(self, url: str):
+        """move the secondary to SUSPECTED / UNHEALTHY based on phi (or too many failed probes)"""
+        from main import topics
+
         async with self._lock:
-            self._missed_beats[url] += 1
+            phi = self._detectors[url].phi()
             missed = self._missed_beats[url]
+            went_down = False
 
-            if missed >= settings.unhealthy_threshold:
+            if phi >= settings.phi_unhealthy_threshold or missed >= settings.unhealthy_threshold:
                 if self._status[url] != SecondaryHealth.UNHEALTHY:
-                    log.warning(f"{url} is now UNHEALTHY (missed {missed} heartbeats)")
+                    log.warning(f"{url} is now UNHEALTHY (phi={phi:.1f}, missed {missed} heartbeats)")
+                    went_down = True
                 self._status[url] = SecondaryHealth.UNHEALTHY
-            elif missed >= settings.suspect_threshold:
-                if self._status[url] != SecondaryHealth.SUSPECTED:
-                    log.warning(f"{url} is now SUSPECTED (missed {missed} heartbeats)")
-                self._status[url] = SecondaryHealth.SUSPECTED
+            elif phi >= settings.phi_suspect_threshold or missed >= settings.suspect_threshold:
+                if self._status[url] == SecondaryHealth.HEALTHY:
+                    log.warning(f"{url} is now SUSPECTED (phi={phi:.1f}, missed {missed} heartbeats)")
+                    self._status[url] = SecondaryHealth.SUSPECTED
+
+        if went_down:
+            # open its circuit breakers, writes needing it fail fast from now on
+            for topic in topics.values():
+                topic.replication_manager.on_health_change(url, SecondaryHealth.UNHEALTHY)
 
     async def get_status(self, url: str) -> SecondaryHealth:
         async with self._lock:
@@ -84,12 +175,15 @@ class HealthTracker:
                     "status": self._status[url].value,
                     "missed_heartbeats": self._missed_beats[url],
                     "last_seen": self._last_seen[url].isoformat(),
+                    "phi": round(min(self._detectors[url].phi(), 1e6), 2),
                 }
                 for url in self._status
             }
 
     async def mark_successful_replication(self, url: str):
         """Call this when replication succeeds - acts as implicit heartbeat"""
+        if str(url) not in self._status:
+            return  # a secondary forwarding down a chain / tree, not tracked here
         await self._mark_healthy(str(url))
 
     # prevents writing when too many nodes are down
@@ -1,13 +1,24 @@
 import asyncio
-import logging
+import random
+import time
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple
 
 import httpx
-from fastapi.encoders import jsonable_encoder
 
-from app.pydantic_models import SecondaryHealth
+from app.entry import Entry
+from app.pydantic_models import BreakerState, SecondaryHealth
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.replication import send_batch
+from app.services.topology import build_tree, descendants
+from app.services.transport import transport
+from app.snapshot import MEDIA_TYPE as SNAPSHOT_MEDIA_TYPE
+from app.snapshot import encode_chunk
 from settings import settings
 
-log = logging.getLogger("REPLICATION_MANAGER")
+# drain rate: min length of one throughput sample, weight of the newest sample
+_DRAIN_SAMPLE_SECS = 0.5
+_DRAIN_EWMA_ALPHA = 0.3
 
 # I've encountered a problem, when everything seems to be working fine,
 # nonetheless, after restarting one of the secondary servers, I saw that it has no messages at all, moreover,
@@ -17,111 +28,728 @@ log = logging.getLogger("REPLICATION_MANAGER")
 # I also like the idea of having some redis server holding this, instead of my coding, however
 
 
+class AckWindow:
+    """
+    What one secondary has ACK'ed, without remembering every id:
+    everything <= `through` (contiguous high-water mark) + sorted disjoint runs above it
+
+    runs only exist while ACKs arrive out of order, as soon as the gap closes they fold into `through`
+    """
+
+    def __init__(self) -> None:
+        self.through = 0
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+
+    def add(self, start: int, end: int) -> None:
+        """mark [start, end] as ACK'ed"""
+        if end <= self.through:
+            return
+        start = max(start, self.through + 1)
+
+        # merge with every run that overlaps or touches [start, end]
+        lo = bisect_right(self._ends, start - 2)
+        hi = bisect_right(self._starts, end + 1)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+        # the first run touches the watermark, fold it in
+        if self._starts[0] <= self.through + 1:
+            self.through = self._ends[0]
+            del self._starts[0], self._ends[0]
+
+    def covers(self, start: int, end: int) -> bool:
+        """is the whole [start, end] ACK'ed"""
+        if end <= self.through:
+            return True
+        i = bisect_right(self._starts, max(start, self.through + 1)) - 1
+        return i >= 0 and self._ends[i] >= end
+
+    def count(self, upto: int) -> int:
+        """how many ids <= upto are ACK'ed, O(out-of-order runs)"""
+        total = min(self.through, upto)
+        for start, end in zip(self._starts, self._ends):
+            if start > upto:
+                break
+            total += min(end, upto) - start + 1
+        return total
+
+    def gaps(self, upto: int) -> Iterable[Tuple[int, int]]:
+        """missing [start, end] ranges in (through, upto], in id order"""
+        cursor = self.through + 1
+        for start, end in zip(self._starts, self._ends):
+            if cursor > upto:
+                return
+            if start > cursor:
+                yield cursor, min(start - 1, upto)
+            cursor = end + 1
+        if cursor <= upto:
+            yield cursor, upto
+
+
+def _runs(msg_ids: List[int]) -> Iterable[Tuple[int, int]]:
+    """[1, 2, 3, 7, 8] -> (1, 3), (7, 8)"""
+    start = prev = None
+    for msg_id in sorted(msg_ids):
+        if prev is not None and msg_id == prev + 1:
+            prev = msg_id
+            continue
+        if start is not None:
+            yield start, prev
+        start = prev = msg_id
+    if start is not None:
+        yield start, prev
+
+
 class ReplicationManager:
     """
     some kind of a storage tracker,
     considers that the master is our sourse of truth
+    one instance per topic (app/topics.py), every topic is replicated as its own stream
 
 
-    each secondary has a set tracking which message IDs it has acknowledged,
-    a background loop periodically compares these and sends missing messages (difference)
+    each secondary has an AckWindow (high-water mark + out-of-order runs) of what it acknowledged,
+    and a worker that owns ALL outbound replication to it (live writes and catch-up alike):
+    it asks the store for the ranges above the watermark and sends them as batches.
+    The log itself is the queue, nothing is copied per message - the worker only keeps
+    up to `repl_max_inflight` batches / `repl_max_inflight_bytes` on the wire (pipelining + memory ceiling)
 
-    When a secondary crashes, any in-flight retry loops will die with the request context, nonetheless
-    a persistent background loop survives and will catch up the secondary when it recovers,
+    workers are event driven, they sleep until woken by: a commit, a finished or failed batch,
+    the HealthTracker seeing the secondary HEALTHY again, or their own retry timer.
+    An idle (or dead) secondary costs nothing, a recovered one is caught up right away
+
+    a secondary more than `snapshot_threshold` messages behind (new or wiped) gets one streamed
+    snapshot instead, then the worker continues with batches from the snapshot's last id
+
+    write-concern waiters don't own any retry tasks, they subscribe to ACK progress (wait_for_acks)
+    a CircuitBreaker per secondary (opened by replication errors or the HealthTracker) lets
+    writes whose w can't be reached fail in milliseconds instead of hanging
+
+    When a secondary crashes, nothing is lost on the master side,
+    the persistent worker will catch up the secondary when it recovers,
     regardless of when the original POST happened
     """
 
-    def __init__(self):
+    def __init__(self, topic):
+        self.topic = topic
+        self.log = topic.logger("REPLICATION_MANAGER")
         self._running = False
 
-        # track secondaries ACK's as url: set[ids]
-        self._delivered: dict[str, set[int]] = {
-            str(url): set() for url in settings.secondaries
-        }
+        # track secondaries ACK's as url: watermark (+ out-of-order runs)
+        self._delivered: dict[str, AckWindow] = {}
         # prevent race conditions and corruptions
-        self._locks: dict[str, asyncio.Lock] = {
-            str(url): asyncio.Lock() for url in settings.secondaries
-        }
+        self._locks: dict[str, asyncio.Lock] = {}
+        # worker wake-ups, and ACK progress for waiters (replaced on every ACK, like LogStore._new_entries)
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._progress = asyncio.Event()
+        self._version = 0  # bumped with every progress event, for the upstream long-polls
+
+        # outbound window: [first, last] ranges on the wire + their payload size
+        self._inflight: dict[str, List[Tuple[int, int]]] = {}
+        self._inflight_bytes: dict[str, int] = {}
+        # consecutive failed batches + the pending backoff timer (None: not backing off)
+        self._failures: dict[str, int] = {}
+        self._retry_timers: dict[str, Optional[asyncio.TimerHandle]] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        # process identity each secondary last reported, a new one means its memory is gone
+        self._incarnations: dict[str, Optional[str]] = {}
+        # ACK'ed messages/sec (EWMA) + the current sample (monotonic start, count), for admission control
+        self._drain_rate: dict[str, float] = {}
+        self._drain_sample: dict[str, Tuple[float, int]] = {}
+
+        # chain / tree topology (see app/services/topology.py): the nodes this one pushes to,
+        # each with the subtree it forwards to in turn. Everything else is only tracked
+        self._downstream: dict[str, List[dict]] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._watchers: dict[str, asyncio.Task] = {}
+        # secondaries the HealthTracker declared UNHEALTHY, routed around (master)
+        self._down: set = set()
+
+        for url in settings.secondaries:
+            self._add(str(url))
+
+    def _add(self, url: str):
+        """state for a secondary, on the master all of them, elsewhere the ones downstream of this node"""
+        if url in self._delivered:
+            return
+        self._delivered[url] = AckWindow()
+        self._locks[url] = asyncio.Lock()
+        self._wakeups[url] = asyncio.Event()
+        self._inflight[url] = []
+        self._inflight_bytes[url] = 0
+        self._failures[url] = 0
+        self._retry_timers[url] = None
+        self._breakers[url] = CircuitBreaker(
+            settings.breaker_failure_threshold, settings.breaker_reset_secs
+        )
+        self._incarnations[url] = None
+        self._drain_rate[url] = 0.0
+        self._drain_sample[url] = (time.monotonic(), 0)
 
     async def start(self):
         """
-        start background sync loops for all the secondaries
+        master: push to the secondaries (directly, or to the first hops of the chain / tree)
+        secondary: nothing until an upstream node hands it a subtree (set_downstream)
 
         should be called once during application startup, yet, idempotent
         """
-        if settings.role != "master" or self._running:
+        if self._running:
             return
         self._running = True
-        for url in settings.secondaries:
-            # task per secondary
-            asyncio.create_task(self._sync_loop(str(url)))
+        if settings.role == "master":
+            self._reroute()
+            self.log.info("Replication manager started")
+
+    def set_downstream(self, tree: List[dict]):
+        """
+        the nodes this one pushes to (+ the subtree each of them forwards to), idempotent
+        workers start on first use and idle while their secondary isn't a child,
+        children with a subtree get a watcher that hands it over and brings their progress back,
+        on a forwarding secondary leaf children are watched too (see _watch)
+        """
+        children = {node["url"]: node["children"] for node in tree}
+        if children == self._downstream:
+            return
+        for url in descendants(tree):
+            self._add(url)
 
-        log.info("Replication manager started")
+        previous, self._downstream = self._downstream, children
+        for url, subtree in previous.items():
+            if children.get(url) != subtree and url in self._watchers:
+                self._watchers.pop(url).cancel()
+        for url, subtree in children.items():
+            if url not in self._workers or self._workers[url].done():
+                # task per secondary, first round catches up whatever is already in the log
+                self._workers[url] = asyncio.create_task(self._sync_loop(url))
+            # a former subtree has to be taken back too (empty one)
+            if subtree != previous.get(url) and (subtree or previous.get(url) or settings.role != "master"):
+                self._watchers[url] = asyncio.create_task(self._watch(url))
+            self.wake(url)
+        self.log.info(f"Replicating to {list(children)}")
 
-    async def mark_delivered(self, url: str, msg_id: int):
+    def _reroute(self):
+        """master: lay the healthy secondaries out again, UNHEALTHY ones are skipped"""
+        if not self._running:
+            return  # start() does the first layout
+        live = [str(url) for url in settings.secondaries if str(url) not in self._down]
+        self.set_downstream(build_tree(live, settings.repl_fanout))
+
+    async def _watch(self, url: str):
+        """
+        long-poll of a child's /replicate/progress: sends it its subtree and merges the
+        watermarks of that subtree as they move, so ACKs travel back up hop by hop.
+        Runs while the child has a subtree (or once, to take an old one back).
+        A forwarding secondary keeps probing its leaves as well (no long-poll, once per heartbeat
+        interval): it has no heartbeats, this is how it learns that a child was wiped and
+        restarted (new incarnation) and catches it up
         """
-        record that secondary ACK'ed a message
+        version = None
+        while self._running:
+            subtree = self._downstream.get(url)
+            if subtree is None:
+                return
+            # a held long-poll to a leaf would only report its own commits, which its ACKs carry anyway
+            wait_secs = settings.repl_progress_wait_secs if subtree else 0
+            try:
+                r = await transport.client(url).post(
+                    url.rstrip("/") + self.topic.path("/replicate/progress"),
+                    json={
+                        "downstream": subtree,
+                        "version": version,
+                        "wait_secs": wait_secs,
+                    },
+                    timeout=wait_secs + settings.repl_timeout_secs,
+                )
+                r.raise_for_status()
+                reply = r.json()
+            except Exception as e:
+                self.log.debug(f"Progress long-poll to {url} failed: {e}")
+                await asyncio.sleep(settings.heartbeat_interval_secs)
+                continue
+
+            version = reply["version"]
+            own = reply["self"]
+            await self.seed_progress(url, own["incarnation"], own["committed_through"])
+            for target, progress in reply["progress"].items():
+                if target not in self._delivered:
+                    continue
+                known = self._incarnations[target]
+                if known is not None and progress["incarnation"] != known:
+                    continue  # stale (or newer than we know), its own ACKs / heartbeats settle it
+                await self.seed_progress(
+                    target, progress["incarnation"], progress["committed_through"]
+                )
+            if not subtree:
+                if settings.role == "master":
+                    return  # the master's heartbeats probe its leaves
+                await asyncio.sleep(settings.heartbeat_interval_secs)
+
+    async def wait_for_progress(self, known: Optional[int], timeout: float) -> int:
+        """an upstream long-poll: returns the progress version once it differs from `known`"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._version == known:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self._version
+
+    def report(self) -> dict:
+        """what this node knows about every secondary downstream of it"""
+        return {
+            url: {
+                "incarnation": self._incarnations[url],
+                "committed_through": self._delivered[url].through,
+            }
+            for url in self._delivered
+        }
+
+    def on_commit(self):
+        """the local log grew (secondary applier): forward it, and let the upstream long-poll see it"""
+        self.wake()
+        self._notify_progress()
+
+    async def mark_delivered_many(self, url: str, msg_ids: List[int]):
+        """
+        record that secondary ACK'ed these messages (one cumulative ACK)
         prevents duplicate sends
 
         Args:
             url: (e.g. "http://secondary1:8000/")
-            msg_id: ID of the successfully delivered message
+            msg_ids: IDs of the successfully delivered messages
         """
         async with self._locks[url]:
-            self._delivered[url].add(msg_id)
+            for start, end in _runs(msg_ids):
+                self._delivered[url].add(start, end)
+        self._sample_drain(url, len(msg_ids))
+        self._notify_progress()
+
+    async def seed_progress(
+        self,
+        url: str,
+        incarnation: Optional[str],
+        committed_through: int,
+        buffered_ids: Iterable[int] = (),
+    ):
+        """
+        what the secondary itself reports to hold (heartbeat / batch ACK):
+        every id <= committed_through + the out-of-order ids it buffered above that
+
+        same incarnation: merged into the window, a report is a snapshot and never takes ACKs back.
+        New incarnation (the secondary restarted, or we did and know nothing yet):
+        the report replaces the window, so after a master restart the workers resume from the
+        secondaries' watermarks instead of replaying the log, and a secondary that lost its
+        memory is caught up from where it really is
+
+        a report past our own log, or (new incarnation) whose tail differs from ours,
+        is a divergent log: the window is left alone, the worker's batches then hit the 409 conflict
+        """
+        buffered_ids = list(buffered_ids)
+        highest = max([committed_through, *buffered_ids])
+        if highest > self.topic.store.last_id():
+            self.log.warning(
+                f"{url} reports id={highest} past our last id={self.topic.store.last_id()}, "
+                f"divergent log, not counted as replicated"
+            )
+            return
+        if (
+            incarnation is not None
+            and incarnation != self._incarnations[url]
+            and committed_through > 0
+            and not await self._tail_matches(url, committed_through)
+        ):
+            self.log.warning(
+                f"{url} holds different entries at or before id={committed_through}, "
+                f"divergent log, not counted as replicated"
+            )
+            return
+
+        async with self._locks[url]:
+            known = self._incarnations[url]
+            restarted = incarnation is not None and incarnation != known
+            if restarted:
+                if known is not None:
+                    self.log.info(f"{url} restarted, resuming from its id={committed_through}")
+                self._incarnations[url] = incarnation
+                self._delivered[url] = AckWindow()
+                transport.renegotiate(url)
+
+            window = self._delivered[url]
+            before = window.through
+            if committed_through > 0:
+                window.add(1, committed_through)
+            for start, end in _runs(buffered_ids):
+                window.add(start, end)
+            moved = window.through != before
+
+        if restarted or moved:
+            self._notify_progress()
+            self.wake(url)
+
+    async def _tail_matches(self, url: str, through: int) -> bool:
+        """
+        does the secondary end exactly where we do at `through`: the hashes of the last leaf
+        (anti_entropy_leaf_size ids) are compared one by one. Bounded on purpose, a full-log range hash
+        reads and hashes a recovered WAL from disk on both sides. A log that diverged (ids handed out
+        again after a master lost its tail) differs right there, anything older is anti-entropy's job
+        """
+        lo = max(through - settings.anti_entropy_leaf_size + 1, 1)
+        try:
+            r = await transport.client(url).post(
+                url.rstrip("/") + self.topic.path("/replicate/digest"),
+                json={"upto": through, "entries": [[lo, through]]},
+            )
+            r.raise_for_status()
+            theirs = r.json()
+        except Exception as e:
+            self.log.debug(f"Digest from {url} failed: {e}")
+            return False
+        ours = await self.topic.store.entry_hashes(lo, through)
+        return theirs["last_id"] == through and theirs["entries"] == [ours]
+
+    def _sample_drain(self, url: str, acked: int):
+        now = time.monotonic()
+        started, count = self._drain_sample[url]
+        count += acked
+        elapsed = now - started
+        if self.lag(url) == 0:
+            # caught up, the next sample starts with the next backlog (idle time isn't drain time)
+            self._drain_sample[url] = (now, 0)
+        elif elapsed >= _DRAIN_SAMPLE_SECS:
+            rate = count / elapsed
+            prev = self._drain_rate[url]
+            self._drain_rate[url] = rate if prev == 0 else prev + _DRAIN_EWMA_ALPHA * (rate - prev)
+            self._drain_sample[url] = (now, 0)
+        else:
+            self._drain_sample[url] = (started, count)
+
+    def lag(self, url: str) -> int:
+        """messages the secondary hasn't ACK'ed yet (no awaits, so no lock needed)"""
+        store = self.topic.store
+
+        last_id = store.last_id()
+        return last_id - self._delivered[url].count(last_id)
+
+    def drain_rate(self, url: str) -> float:
+        """recent ACK throughput of the secondary in messages/sec, 0 if unknown yet"""
+        return self._drain_rate[url]
+
+    def _notify_progress(self):
+        self._version += 1
+        progress, self._progress = self._progress, asyncio.Event()
+        progress.set()
+
+    def breaker_state(self, url: str) -> BreakerState:
+        return self._breakers[url].state
+
+    def on_health_change(self, url: str, status: SecondaryHealth):
+        """HealthTracker transitions drive the breakers (and wake the worker on recovery)"""
+        if status == SecondaryHealth.UNHEALTHY:
+            self._breakers[url].trip()
+            self._notify_progress()  # waiters that needed this secondary can give up now
+            self._down.add(url)
+        elif status == SecondaryHealth.HEALTHY:
+            self._breakers[url].record_success()
+            self._failures[url] = 0
+            self._cancel_retry(url)
+            self._down.discard(url)
+            # catch it up right away instead of waiting for the next commit
+            self.wake(url)
+        # route the chain / tree around it (the phi thresholds are the grace period)
+        self._reroute()
+
+    def wake(self, url: Optional[str] = None):
+        """wake the worker of one secondary (or all of them), cheap and safe to call often"""
+        for target in [url] if url is not None else self._wakeups:
+            self._wakeups[target].set()
+
+    async def count_acks(self, first_id: int, last_id: int) -> Tuple[int, int]:
+        """
+        (acked, reachable) secondaries for the whole [first_id, last_id] run
+        reachable = already ACK'ed + not yet, but with a CLOSED breaker
+        """
+        acks = reachable = 0
+        for url in self._delivered:
+            async with self._locks[url]:
+                acked = self._delivered[url].covers(first_id, last_id)
+            acks += acked
+            reachable += acked or self._breakers[url].state == BreakerState.CLOSED
+        return acks, reachable
+
+    def available_count(self) -> int:
+        """secondaries that can take writes right now (breaker CLOSED)"""
+        return sum(b.state == BreakerState.CLOSED for b in self._breakers.values())
+
+    async def wait_for_acks(
+        self,
+        first_id: int,
+        last_id: int,
+        required: int,
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, int]:
+        """
+        write-concern waiters block here until `required` secondaries ACK'ed the run
+        one wake-up per ACK (or breaker change) for all waiters, no per-write tasks or retry loops
+
+        gives up early when fewer than `required` secondaries are still reachable, or on timeout,
+        returns the final (acked, reachable) so the caller can tell the two apart
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            progress = self._progress
+            acks, reachable = await self.count_acks(first_id, last_id)
+            if acks >= required or reachable < required:
+                return acks, reachable
+
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return acks, reachable
+            try:
+                await asyncio.wait_for(progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                return acks, reachable
+
+    async def get_missing(
+        self,
+        url: str,
+        upto: Optional[int] = None,
+        limit: Optional[int] = None,
+        skip_inflight: bool = False,
+    ) -> List[Entry]:
+        """
+        messages the secondary hasn't ACK'ed yet, in id order (total ordering)
+
+        Args:
+            upto: only ids <= upto
+            limit: at most that many, the oldest ones
+            skip_inflight: leave out ranges that are currently being sent
+        """
+        store = self.topic.store
+
+        last_id = store.last_id()
+        if upto is None or upto > last_id:
+            upto = last_id
+        async with self._locks[url]:
+            gaps = list(self._delivered[url].gaps(upto))
+        if skip_inflight:
+            gaps = _subtract(gaps, sorted(self._inflight[url]))
+
+        # only the ranges above the watermark are read, O(gap) instead of a full log scan
+        missing: List[Entry] = []
+        for start, end in gaps:
+            if limit is not None:
+                end = min(end, start + limit - len(missing) - 1)
+            missing += await store.range(start, end + 1)
+            if limit is not None and len(missing) >= limit:
+                break
+        return missing
 
     async def get_pending_count(self, url: str) -> int:
         """
         health router needs to get info about pending list, it's just an async way to provide it
         also, this type of logic must be separated from the router
         """
-        from main import store
-
-        all_messages = await store.list_all()
         async with self._locks[url]:
-            return len([m for m in all_messages if m.id not in self._delivered[url]])
+            return self.lag(url)
 
     async def _sync_loop(self, url: str):
-        from app.services.health_tracker import health_tracker
-        from main import store
+        wakeup = self._wakeups[url]
+        loop = asyncio.get_running_loop()
 
-        while True:
-            # polling interval is a balance between responsiveness and CPU usage
-            await asyncio.sleep(2.0)
+        while self._running:
+            # sleeps until there is a reason to look at this secondary
+            await wakeup.wait()
+            wakeup.clear()
 
-            # don't bother trying if the secondary is known to be down (either spams errors)
-            health_status = await health_tracker.get_status(url)
-            if health_status == SecondaryHealth.UNHEALTHY:
+            # not (or no longer) pushed to by this node, someone else up the tree forwards to it
+            # UNHEALTHY secondaries are taken out of the layout as well, the health tracker
+            # puts them back (and wakes us up) as soon as it sees them HEALTHY again
+            if url not in self._downstream:
                 continue
 
-            #  determine which messages this secondary is missing
-            all_messages = await store.list_all()
-            async with self._locks[url]:
-                missing = [m for m in all_messages if m.id not in self._delivered[url]]
+            # backing off after a failure, the retry timer wakes us up once it has fired
+            # (a flag, not a deadline: uvloop rounds timers and may fire them a bit early)
+            if self._retry_timers[url] is not None:
+                continue
 
-            if not missing:
+            # breaker open: nothing goes out until it lets a trial batch through
+            breaker = self._breakers[url]
+            if breaker.state == BreakerState.OPEN:
+                loop.call_later(breaker.retry_in(), self.wake, url)
                 continue
 
-            # total ordering, sort by id
-            missing.sort(key=lambda m: m.id)
-
-            # below is an attempt to deliver missing data
-            target = url.rstrip("/") + "/replicate"
-            timeout = httpx.Timeout(settings.repl_timeout_secs, connect=5.0)
-
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                for msg in missing:
-                    try:
-                        r = await client.post(target, json=jsonable_encoder(msg))
-                        r.raise_for_status()
-                        if r.json().get("status") == "ok":
-                            await self.mark_delivered(url, msg.id)
-                            await health_tracker.mark_successful_replication(url)
-                            log.info(f"Sync delivered id={msg.id} to {url}")
-                    except Exception as e:
-                        log.debug(f"Sync failed for id={msg.id} to {url}: {e}")
-                        break
-
-
-# module-level instance acts as a singleton (python caches modules)
-replication_manager = ReplicationManager()
+            # far behind (new or wiped secondary): one streamed snapshot instead of batches
+            if (
+                settings.snapshot_threshold > 0
+                and not self._inflight[url]
+                and breaker.state == BreakerState.CLOSED
+                and self.lag(url) >= settings.snapshot_threshold
+            ):
+                await self._send_snapshot(url)
+                continue
+
+            await self._fill_window(url)
+
+    async def _fill_window(self, url: str):
+        """start batches for whatever is missing, until the in-flight window or byte budget is full"""
+        window = settings.repl_max_inflight
+        if self._breakers[url].state == BreakerState.HALF_OPEN:
+            window = 1  # a single trial batch
+
+        while len(self._inflight[url]) < window:
+            budget = settings.repl_max_inflight_bytes - self._inflight_bytes[url]
+            if budget <= 0:
+                return
+
+            #  determine which messages this secondary is missing (already in id order)
+            batch = await self.get_missing(
+                url, limit=settings.repl_batch_size, skip_inflight=True
+            )
+            if not batch:
+                return
+
+            # memory ceiling, but always at least one message so huge ones still get through
+            size = _encoded_size(batch[0])
+            for i, msg in enumerate(batch[1:], start=1):
+                msg_size = _encoded_size(msg)
+                if size + msg_size > budget:
+                    batch = batch[:i]
+                    break
+                size += msg_size
+
+            # registered before the task starts, so the next get_missing skips it
+            span = (batch[0].id, batch[-1].id)
+            self._inflight[url].append(span)
+            self._inflight_bytes[url] += size
+            asyncio.create_task(self._send(url, batch, span, size))
+
+    async def _send(self, url: str, batch: List[Entry], span: Tuple[int, int], size: int):
+        try:
+            ok = await send_batch(self.topic, url, batch)
+        except Exception as e:
+            ok = False
+            self.log.warning(f"Replication to {url} failed for ids={span[0]}..{span[1]}: {e}")
+        finally:
+            self._inflight[url].remove(span)
+            self._inflight_bytes[url] -= size
+
+        if ok:
+            self.log.info(f"Delivered ids={span[0]}..{span[1]} to {url}")
+            self._on_success(url)
+        else:
+            self._on_failure(url)
+
+    async def _send_snapshot(self, url: str):
+        """stream the log above the secondary's watermark as a snapshot, the worker waits for it"""
+        store = self.topic.store
+
+        async with self._locks[url]:
+            first_id = self._delivered[url].through + 1
+        last_id = store.last_id()
+        self.log.info(f"Sending snapshot ids={first_id}..{last_id} to {url}")
+
+        async def chunks():
+            for lo in range(first_id, last_id + 1, settings.snapshot_chunk_size):
+                hi = min(lo + settings.snapshot_chunk_size, last_id + 1)
+                yield encode_chunk(await store.range(lo, hi))
+
+        try:
+            r = await transport.client(url).post(
+                url.rstrip("/") + self.topic.path("/snapshot"),
+                content=chunks(),
+                headers={"Content-Type": SNAPSHOT_MEDIA_TYPE},
+            )
+            r.raise_for_status()
+            reply = r.json()
+        except Exception as e:
+            self.log.warning(f"Snapshot to {url} failed: {e}")
+            if not await self._resume_after_gap(url, e):
+                self._on_failure(url)
+            return
+
+        self.log.info(f"Snapshot to {url} done, {reply['count']} messages, now at id={reply['last_id']}")
+        await self.seed_progress(url, reply.get("incarnation"), reply["last_id"])
+        self._on_success(url)
+
+    async def _resume_after_gap(self, url: str, error: Exception) -> bool:
+        """
+        a snapshot gap (409) carries where the secondary really is: a wiped and restarted one
+        isn't probed by a forwarding node, so this is how its new incarnation gets known.
+        True if the window now starts right there (seed_progress woke the worker for the next try)
+        """
+        if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code != 409:
+            return False
+        detail = error.response.json().get("detail")
+        if not isinstance(detail, dict) or "last_id" not in detail:
+            return False
+        await self.seed_progress(url, detail.get("incarnation"), detail["last_id"])
+        return self._delivered[url].through == detail["last_id"]
+
+    def _on_success(self, url: str):
+        breaker = self._breakers[url]
+        if breaker.state != BreakerState.CLOSED:
+            self.log.info(f"Circuit breaker for {url} closed")
+        breaker.record_success()
+        self._failures[url] = 0
+        self.wake(url)  # room in the window again
+
+    def _on_failure(self, url: str):
+        breaker = self._breakers[url]
+        was_open = breaker.state == BreakerState.OPEN
+        breaker.record_failure()
+        if not was_open and breaker.state == BreakerState.OPEN:
+            self.log.warning(f"Circuit breaker for {url} opened")
+            self._notify_progress()
+
+        # exponential backoff with jitter ("equal jitter": half fixed, half random),
+        # so retries of several writers / secondaries don't line up
+        self._failures[url] += 1
+        ceiling = min(
+            settings.repl_backoff_base_secs * 2 ** (self._failures[url] - 1),
+            settings.repl_backoff_max_secs,
+        )
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        self.log.info(
+            f"Replication to {url} failed {self._failures[url]} time(s), retrying in {delay:.2f}s"
+        )
+        self._cancel_retry(url)
+        self._retry_timers[url] = asyncio.get_running_loop().call_later(delay, self._retry, url)
+
+    def _retry(self, url: str):
+        self._retry_timers[url] = None
+        self.wake(url)
+
+    def _cancel_retry(self, url: str):
+        timer, self._retry_timers[url] = self._retry_timers[url], None
+        if timer is not None:
+            timer.cancel()
+
+
+def _encoded_size(msg: Entry) -> int:
+    # utf-8 bytes on the wire, len(content) would count characters
+    return len(msg.content.encode())
+
+
+def _subtract(
+    gaps: List[Tuple[int, int]], spans: List[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """[start, end] gaps minus sorted [start, end] spans"""
+    out = []
+    for start, end in gaps:
+        for span_start, span_end in spans:
+            if span_end < start or span_start > end:
+                continue
+            if span_start > start:
+                out.append((start, span_start - 1))
+            start = max(start, span_end + 1)
+        if start <= end:
+            out.append((start, end))
+    return out
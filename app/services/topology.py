@@ -0,0 +1,31 @@
+from typing import Iterator, List
+
+# a subtree is {"url": ..., "children": [subtree, ...]}, sent as is to the node at its root
+
+
+def build_tree(urls: List[str], fanout: int) -> List[dict]:
+    """
+    the master's children (with their subtrees) for a k-ary layout of [master] + urls:
+    node i pushes to nodes fanout*i+1 .. fanout*i+fanout, so fanout 1 is a chain,
+    fanout 0 keeps the star (master pushes to everyone)
+    """
+    if fanout <= 0:
+        return [{"url": url, "children": []} for url in urls]
+
+    def subtree(i: int) -> dict:
+        first = fanout * i + 1
+        return {
+            "url": urls[i - 1],
+            "children": [subtree(c) for c in range(first, min(first + fanout, len(urls) + 1))],
+        }
+
+    return [subtree(i) for i in range(1, min(fanout, len(urls)) + 1)]
+
+
+def descendants(tree: List[dict]) -> Iterator[str]:
+    """every url in the subtrees, parents before children"""
+    stack = list(reversed(tree))
+    while stack:
+        node = stack.pop()
+        yield node["url"]
+        stack.extend(reversed(node["children"]))
@@ -0,0 +1,121 @@
+import json
+import logging
+from typing import Dict, List, Optional
+
+import httpx
+
+from app import compression, wire
+from app.entry import Entry
+from settings import settings
+
+log = logging.getLogger("TRANSPORT")
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (optional, `pip install httpx[http2]`)
+    except ImportError:
+        return False
+    return True
+
+
+class Transport:
+    """
+    One long-lived connection pool per secondary, shared by replication, heartbeats and catch-up
+
+    before, every retry / heartbeat round / sync round opened its own AsyncClient,
+    so each write paid the TCP setup again. Clients are created in the app lifespan and closed on shutdown
+
+    HTTP/2 is optional: needs the `h2` package and only kicks in for https secondaries
+    (httpx negotiates it through TLS ALPN), otherwise it's keep-alive HTTP/1.1
+
+    runs of messages go out in the binary wire format (app/wire.py) by Content-Type,
+    a secondary that answers 415 / 422 to it (older version) gets JSON from then on.
+    Bodies of at least `repl_compression_min_bytes` are compressed (Content-Encoding) once the
+    secondary has listed the coding in the Accept-Encoding header of a previous response
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._http2 = False
+        # url -> secondary accepts the binary format, unknown = try it
+        self._binary: Dict[str, bool] = {}
+        # url -> content-coding the secondary advertised, None = send uncompressed
+        self._codings: Dict[str, Optional[str]] = {}
+
+    async def start(self):
+        if settings.repl_http2:
+            self._http2 = _http2_available()
+            if not self._http2:
+                log.warning("REPL_HTTP2 is set but `h2` is not installed, using HTTP/1.1")
+
+        for url in settings.secondaries:
+            self.client(str(url))
+        log.info(f"Transport started for {len(self._clients)} secondaries")
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """pooled client for the secondary, created on first use"""
+        client = self._clients.get(url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                # default is the replication timeout, heartbeats pass their own
+                timeout=httpx.Timeout(settings.repl_timeout_secs, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=settings.repl_pool_size,
+                    max_keepalive_connections=settings.repl_pool_size,
+                    keepalive_expiry=settings.repl_keepalive_secs,
+                ),
+                http2=self._http2,
+            )
+            self._clients[url] = client
+        return client
+
+    async def post_entries(self, url: str, path: str, entries: List[Entry]) -> httpx.Response:
+        """POST an ordered run of messages in the format negotiated with this secondary"""
+        client = self.client(url)
+        target = url.rstrip("/") + path
+        while True:
+            binary = settings.repl_wire_format == "binary" and self._binary.get(url, True)
+            if binary:
+                body, headers = wire.encode(entries), {"Content-Type": wire.MEDIA_TYPE}
+            else:
+                body = json.dumps({"messages": [e.to_json() for e in entries]}).encode()
+                headers = {"Content-Type": "application/json"}
+
+            coding = self._codings.get(url)
+            if coding is not None and len(body) >= settings.repl_compression_min_bytes:
+                body = compression.compress(body, coding)
+                headers["Content-Encoding"] = coding
+            else:
+                coding = None
+
+            r = await client.post(target, content=body, headers=headers)
+            if r.status_code == 415 and coding is not None:
+                log.warning(f"{url} doesn't accept {coding} anymore, sending uncompressed")
+                self._codings[url] = None
+                continue
+            self._codings[url] = compression.pick(
+                compression.resolve(settings.repl_compression), r.headers.get("accept-encoding", "")
+            )
+            if binary and r.status_code in (415, 422):
+                if self._binary.get(url) is not False:  # other in-flight requests may have found out first
+                    log.warning(f"{url} doesn't accept {wire.MEDIA_TYPE}, falling back to JSON")
+                self._binary[url] = False
+                continue
+            if binary:
+                self._binary[url] = True
+            return r
+
+    def renegotiate(self, url: str):
+        """the secondary restarted (maybe upgraded), try the binary format again"""
+        self._binary.pop(url, None)
+        self._codings.pop(url, None)
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+# module-level instance acts as a singleton, same as the other services
+transport = Transport()
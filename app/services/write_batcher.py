@@ -0,0 +1,76 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+from app.entry import Entry
+from settings import settings
+
+
+async def commit_and_replicate(topic, contents: List[str]) -> List[Entry]:
+    """
+    master write path for a run of contents:
+    1) consecutive ids + local commit (write-ahead), 2) wake the per-secondary replication workers
+
+    the workers send the run as part of their outbound queue, writers wait for their
+    write concern with replication_manager.wait_for_acks
+    """
+    msgs = await topic.store.append_many(contents)
+    topic.logger(settings.role.upper()).info(
+        f"Committed locally ids={msgs[0].id}..{msgs[-1].id} count={len(msgs)} ts={msgs[0].ts.isoformat()}"
+    )
+
+    topic.replication_manager.wake()
+    return msgs
+
+
+class WriteBatcher:
+    """
+    Group commit for concurrent POST /messages on the master
+
+    writes arriving within `write_batch_window_ms` (or until `write_batch_max` are queued)
+    get consecutive ids, are committed together and wake the replication workers once,
+    instead of one commit + one wake-up each.
+    Every writer still waits only for its own write concern
+    """
+
+    def __init__(self, topic):
+        self.topic = topic
+        self._queue: List[Tuple[str, asyncio.Future]] = []
+        self._full = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def submit(self, content: str) -> Entry:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((content, fut))
+        if len(self._queue) >= settings.write_batch_max:
+            self._full.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+        return await fut
+
+    async def _flush(self):
+        # wait for the window to pass, or for the batch to fill up, whichever comes first
+        if len(self._queue) < settings.write_batch_max:
+            try:
+                await asyncio.wait_for(
+                    self._full.wait(), settings.write_batch_window_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
+
+        batch = self._queue[: settings.write_batch_max]
+        del self._queue[: settings.write_batch_max]
+        self._full.clear()
+        # leftovers start the next window right away
+        self._flusher = asyncio.create_task(self._flush()) if self._queue else None
+
+        try:
+            msgs = await commit_and_replicate(self.topic, [content for content, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (_, fut), msg in zip(batch, msgs):
+            if not fut.done():  # client may have gone away meanwhile
+                fut.set_result(msg)
@@ -0,0 +1,48 @@
+import io
+import struct
+import zlib
+from typing import AsyncIterator, List
+
+from app.entry import Entry
+from app.wal import encode_record, iter_records
+
+# snapshot stream = a sequence of chunks, each one self-contained and checksummed:
+#   first id (Q) | message count (I) | payload length (I) | crc32 of the payload (I) | payload
+# payload = zlib of WAL records (which carry their own crc as well)
+_CHUNK = struct.Struct("<QIII")
+
+MEDIA_TYPE = "application/x-replog-snapshot"
+
+
+def encode_chunk(msgs: List[Entry]) -> bytes:
+    payload = zlib.compress(b"".join(encode_record(msg) for msg in msgs), 1)
+    return _CHUNK.pack(msgs[0].id, len(msgs), len(payload), zlib.crc32(payload)) + payload
+
+
+async def read_chunks(stream: AsyncIterator[bytes]) -> AsyncIterator[List[Entry]]:
+    """
+    decode chunks as the bytes arrive, one list of messages per chunk
+    raises ValueError on a checksum mismatch or a truncated stream
+    """
+    buf = bytearray()
+    async for data in stream:
+        buf += data
+        while len(buf) >= _CHUNK.size:
+            first_id, count, length, crc = _CHUNK.unpack_from(buf)
+            end = _CHUNK.size + length
+            if len(buf) < end:
+                break
+            payload = bytes(buf[_CHUNK.size : end])
+            del buf[:end]
+            yield _decode(first_id, count, payload, crc)
+    if buf:
+        raise ValueError(f"truncated snapshot, {len(buf)} trailing bytes")
+
+
+def _decode(first_id: int, count: int, payload: bytes, crc: int) -> List[Entry]:
+    if zlib.crc32(payload) != crc:
+        raise ValueError(f"checksum mismatch in chunk starting at id={first_id}")
+    msgs = [msg for _, _, msg in iter_records(io.BytesIO(zlib.decompress(payload)))]
+    if len(msgs) != count or (msgs and msgs[0].id != first_id):
+        raise ValueError(f"corrupted chunk starting at id={first_id}")
+    return msgs
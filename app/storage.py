@@ -1,40 +1,304 @@
 import asyncio
-from typing import Dict, List, Optional
+from array import array
+from datetime import datetime
+from typing import List, Optional, Tuple
 
-from app.pydantic_models import Message
+from app.compression import compress, decompress
+from app.entry import Entry, ts_to_micros
+from app.range_hash import RangeHashIndex, combine, entry_hash
+from app.wal import SegmentedWAL
+
+
+class _Columns:
+    """
+    The in-memory part of the log, column-wise: ts (micros) in an array('q'), contents packed
+    into one utf-8 bytearray + an array('Q') of offsets. IDs are implicit (dense, base + index)
+
+    ~16 bytes + the content per message, instead of a pydantic model with a datetime and a str
+    (several hundred bytes). Entries are only materialized for the slices that are read
+
+    with `compression` set, every full block of `block_size` contents is compressed and only the
+    open tail stays raw; offsets keep counting uncompressed bytes, so block b starts at
+    offsets[b * block_size]. A read decompresses just the blocks it touches (the last one is cached),
+    replication and fresh tails mostly read the raw tail
+    """
+
+    def __init__(self, compression: Optional[str] = None, block_size: int = 1024) -> None:
+        self._ts = array("q")
+        self._offsets = array("Q", [0])  # content i lives in data[offsets[i]:offsets[i + 1]]
+        self._data = bytearray()  # everything after the sealed blocks
+        self._compression = compression
+        self._block_size = block_size
+        self._blocks: List[bytes] = []
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    def append(self, entry: Entry) -> None:
+        data = entry.content.encode()
+        self._ts.append(entry.ts_us)
+        self._data += data
+        self._offsets.append(self._offsets[-1] + len(data))
+        if self._compression is not None and len(self._ts) - self._tail_index() >= self._block_size:
+            self._blocks.append(compress(bytes(self._data), self._compression))
+            self._data = bytearray()
+
+    def slice(self, lo: int, hi: int, first_id: int) -> List[Entry]:
+        """entries lo <= index < hi, `first_id` is the id of index 0"""
+        hi = min(hi, len(self._ts))
+        ts, offsets = self._ts, self._offsets
+        out: List[Entry] = []
+        while lo < hi:
+            base, data, end = self._chunk(lo)
+            end = min(end, hi)
+            out.extend(
+                Entry(first_id + i, ts[i], data[offsets[i] - base : offsets[i + 1] - base].decode())
+                for i in range(lo, end)
+            )
+            lo = end
+        return out
+
+    def replace(self, i: int, entry: Entry) -> None:
+        """overwrite index i (anti-entropy repairs, rare), shifts the offsets after it"""
+        data = entry.content.encode()
+        start, end = self._offsets[i], self._offsets[i + 1]
+        block = i // self._block_size if self._compression is not None else len(self._blocks)
+        if block < len(self._blocks):
+            base, raw, _ = self._chunk(i)
+            raw = raw[: start - base] + data + raw[end - base :]
+            self._blocks[block] = compress(raw, self._compression)
+            self._cached = (-1, b"")
+        else:
+            base = self._offsets[self._tail_index()]
+            self._data[start - base : end - base] = data
+        self._ts[i] = entry.ts_us
+        delta = len(data) - (end - start)
+        if delta:
+            for j in range(i + 1, len(self._offsets)):
+                self._offsets[j] += delta
+
+    def _tail_index(self) -> int:
+        return len(self._blocks) * self._block_size
+
+    def _chunk(self, i: int) -> Tuple[int, bytes, int]:
+        """(uncompressed offset of its first byte, content bytes, end index) of the block holding index i"""
+        tail = self._tail_index()
+        if i >= tail:
+            return self._offsets[tail], self._data, len(self._ts)
+        block = i // self._block_size
+        if self._cached[0] != block:
+            self._cached = (block, decompress(self._blocks[block], self._compression))
+        first = block * self._block_size
+        return self._offsets[first], self._cached[1], first + self._block_size
 
 
 class LogStore:
     """
-    Simple message storage logic, some kind of a wrapper around the dict
+    Simple message storage logic, append-only columns (_Columns) + the id of their first element
+
+    IDs are dense and monotonic on both roles (master assigns them, secondaries commit strictly in order),
+    so message `id` lives at index `id - _base_id` - no sorting, no dict, reads are slices
+
+    everything in and out is an Entry (plain tuple), the routers build pydantic models from them
 
     explicit Lock is provided, because between the yield and writing to some memory, another
     coroutine can work with the data, e.g:
         val = await ...
         *another coroutine runs and changes val*
         _ = [for i in val]
+
+    optionally backed by a SegmentedWAL: every commit is appended to disk and waits for the
+    (group committed) fsync. After a restart only the last id is restored from the WAL index,
+    the recovered prefix (ids < _base_id) is read from disk on demand instead of being loaded.
+    Readers (last_id, range, tail) only see entries up to the durable high-water mark, so nothing
+    is replicated or served before its fsync, a crash can't take back what others already saw
+
+    a RangeHashIndex over the log is updated on every commit, anti-entropy compares it between
+    nodes (the recovered prefix is hashed lazily, on the first range_hash call)
     """
 
-    def __init__(self) -> None:
-        self._messages: Dict[int, Message] = {}
+    def __init__(
+        self,
+        backend: Optional[SegmentedWAL] = None,
+        hash_leaf_size: int = 1024,
+        compression: Optional[str] = None,
+        compression_block: int = 1024,
+    ) -> None:
+        self._entries = _Columns(compression, compression_block)
         self._lock = asyncio.Lock()  # use explicit lock to prevent data corruption
-        self._next_id = 1
+        self._backend = backend
+        self._base_id = (backend.last_id if backend is not None else 0) + 1
+        # replaced on every commit, so all tail subscribers wake up once per commit
+        self._new_entries = asyncio.Event()
+        self._hashes = RangeHashIndex(hash_leaf_size)
+        self._hash_lock = asyncio.Lock()
+        self._prefix_hashed = self._base_id == 1
+        # highest id whose WAL record is fsynced, everything up to it is visible to readers
+        self._durable_id = self._base_id - 1
+
+    def __len__(self) -> int:
+        return self._durable_id
 
-    async def reserve_id(self) -> int:
+    def last_id(self) -> int:
+        """0 for an empty log, durable entries only"""
+        return self._durable_id
+
+    def _written_id(self) -> int:
+        # in memory, fsync possibly still pending; no await between mutations, so no lock needed
+        return self._base_id - 1 + len(self._entries)
+
+    async def append_many(self, contents: List[str]) -> List[Entry]:
+        """
+        master write path: assign consecutive ids to `contents` and commit them as one run,
+        single lock acquisition and a single (group) fsync for the whole run
+        """
         async with self._lock:
-            return self._next_id
+            first_id = self._written_id() + 1
+            now = ts_to_micros(datetime.now())  # .now == utcnow()
+            msgs = [Entry(first_id + i, now, content) for i, content in enumerate(contents)]
+            seq = self._append(msgs)
+
+        await self._make_durable(seq, msgs[-1].id)
+        return msgs
 
-    async def commit(self, msg: Message) -> None:
+    async def commit_many(self, msgs: List[Entry]) -> None:
+        """
+        already numbered, consecutive run (secondaries), same single lock + fsync as append_many
+        the fsync is awaited outside of the lock, so concurrent commits share it
+        """
         async with self._lock:
-            self._messages[msg.id] = msg
-            self._next_id = max(self._next_id, msg.id + 1)
+            first_id = self._written_id() + 1
+            if msgs[0].id != first_id or msgs[-1].id != first_id + len(msgs) - 1:
+                raise ValueError(
+                    f"commit out of order: ids={msgs[0].id}..{msgs[-1].id}, next={first_id}"
+                )
+            seq = self._append(msgs)
+
+        await self._make_durable(seq, msgs[-1].id)
+
+    async def _make_durable(self, seq: int, last_id: int) -> None:
+        """
+        wait for the fsync of WAL record `seq`, then publish everything up to `last_id`
+        the WAL syncs in order, so when a later run finishes first, the earlier one is durable too
+        """
+        if self._backend is not None:
+            await self._backend.sync(seq)
+        self._durable_id = max(self._durable_id, last_id)
+        self._notify()
 
-    async def list_all(self) -> List[Message]:
+    def _append(self, msgs: List[Entry]) -> int:
+        # caller holds the lock
+        seq = 0
+        for msg in msgs:
+            if self._backend is not None:
+                seq = self._backend.append(msg)
+            self._entries.append(msg)
+            self._hashes.add(msg)
+        return seq
+
+    async def wait_for_new(self, after_id: int, timeout: Optional[float] = None) -> bool:
+        """
+        block until the log has entries newer than `after_id`
+        returns False on timeout, streaming readers use that for keep-alives
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.last_id() <= after_id:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._new_entries.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _notify(self) -> None:
+        event, self._new_entries = self._new_entries, asyncio.Event()
+        event.set()
+
+    async def range(self, start_id: int, end_id: int) -> List[Entry]:
+        """messages with start_id <= id < end_id, in ID order (durable ones only)"""
+        start_id = max(start_id, 1)
+        end_id = min(end_id, self._durable_id + 1)
+        # the recovered prefix is immutable, no need to hold the lock while reading the disk
+        recovered = await self._read_disk(start_id, min(end_id, self._base_id))
         async with self._lock:
-            # return in ID order
-            return [self._messages[k] for k in sorted(self._messages.keys())]
+            lo = max(start_id - self._base_id, 0)
+            hi = max(end_id - self._base_id, 0)
+            return recovered + self._entries.slice(lo, hi, self._base_id)
+
+    async def tail(self, after_id: int, limit: Optional[int] = None) -> List[Entry]:
+        """messages newer than `after_id`, at most `limit` of them"""
+        end_id = self.last_id() + 1
+        if limit is not None:
+            end_id = min(end_id, after_id + 1 + limit)
+        return await self.range(after_id + 1, end_id)
 
     # get_by_id to implement the deduplication
-    async def get_by_id(self, msg_id: int) -> Optional[Message]:
-        async with self._lock:
-            return self._messages.get(msg_id)
+    async def get_by_id(self, msg_id: int) -> Optional[Entry]:
+        found = await self.range(msg_id, msg_id + 1)
+        return found[0] if found else None
+
+    async def overwrite(self, msg: Entry) -> bool:
+        """
+        anti-entropy repair: replace an existing entry with the master's version
+        False if the id isn't in the log yet (that's regular replication's job) or already equal
+        """
+        # ordered before the store lock, so a running prefix hashing pass sees either version whole
+        async with self._hash_lock:
+            old = await self.get_by_id(msg.id)
+            if old is None or old == msg:
+                return False
+
+            if self._backend is not None:
+                await asyncio.to_thread(self._backend.repair, msg)
+            async with self._lock:
+                if msg.id >= self._base_id:
+                    self._entries.replace(msg.id - self._base_id, msg)
+                if self._prefix_hashed or msg.id >= self._base_id:
+                    self._hashes.remove(old)
+                    self._hashes.add(msg)
+        return True
+
+    async def range_hash(self, lo: int, hi: int) -> int:
+        """hash of the entries lo <= id <= hi (clipped to the log), equal logs -> equal hashes"""
+        await self._hash_prefix()
+        hi = min(hi, self.last_id())
+        if lo > hi:
+            return 0
+
+        leaves = self._hashes.full_leaves(lo, hi)
+        if not leaves:
+            return combine(await self.entry_hashes(lo, hi))
+        # partial leaves at the edges are hashed entry by entry
+        size = self._hashes.leaf_size
+        edges = await self.entry_hashes(lo, leaves.start * size)
+        edges += await self.entry_hashes(leaves.stop * size + 1, hi)
+        return combine(edges + [self._hashes.leaves_sum(leaves)])
+
+    async def entry_hashes(self, lo: int, hi: int) -> List[int]:
+        """hash of every entry lo <= id <= hi, in id order"""
+        return [entry_hash(msg) for msg in await self.range(lo, hi + 1)]
+
+    async def _hash_prefix(self) -> None:
+        if self._prefix_hashed:
+            return
+        async with self._hash_lock:
+            if self._prefix_hashed:
+                return
+            chunk = 65536
+            for start in range(1, self._base_id, chunk):
+                for msg in await self._read_disk(start, min(start + chunk, self._base_id)):
+                    self._hashes.add(msg)
+            self._prefix_hashed = True
+
+    async def close(self) -> None:
+        if self._backend is not None:
+            await self._backend.close()
+
+    async def _read_disk(self, start_id: int, end_id: int) -> List[Entry]:
+        if self._backend is None or start_id >= end_id:
+            return []
+        return await asyncio.to_thread(self._backend.read, start_id, end_id)
@@ -0,0 +1,100 @@
+import logging
+import os
+import re
+
+from fastapi import HTTPException, Path, Request
+
+from app.compression import resolve
+from app.services.anti_entropy import AntiEntropy
+from app.services.applier import Applier
+from app.services.gap_filler import GapFiller
+from app.services.replication_manager import ReplicationManager
+from app.services.write_batcher import WriteBatcher
+from app.storage import LogStore
+from app.wal import SegmentedWAL
+from settings import settings
+
+# the log behind the unprefixed routes (/messages, /replicate/...), the only one unless TOPICS says otherwise
+DEFAULT_TOPIC = "default"
+
+_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class Topic:
+    """
+    One independent log: its own id sequence, LogStore (lock, WAL directory), delivery tracking,
+    replication workers, applier and anti-entropy. Topics share nothing but the process,
+    the transport and the health of the nodes, total ordering is per topic
+
+    a process serves the topics in `settings.topics`, so topics can be spread over several
+    processes (one port each) to use every core, see TOPIC_OWNERS for redirects between them
+    """
+
+    def __init__(self, name: str):
+        if not _NAME.match(name) or name in (".", ".."):
+            raise ValueError(f"invalid topic name {name!r}")
+        self.name = name
+        self.store = LogStore(
+            backend=self._backend(),
+            hash_leaf_size=settings.anti_entropy_leaf_size,
+            compression=resolve(settings.store_compression),
+            compression_block=settings.store_compression_block,
+        )
+        self.replication_manager = ReplicationManager(self)
+        self.applier = Applier(self)
+        self.gap_filler = GapFiller(self)
+        self.anti_entropy = AntiEntropy(self)
+        self.write_batcher = WriteBatcher(self)
+
+    def _backend(self):
+        if settings.storage_backend != "wal":
+            return None
+        directory = settings.data_dir
+        if self.name != DEFAULT_TOPIC:  # the default topic keeps the pre-topics layout
+            directory = os.path.join(directory, "topics", self.name)
+        return SegmentedWAL(
+            directory,
+            segment_bytes=settings.wal_segment_bytes,
+            index_interval_bytes=settings.wal_index_interval_bytes,
+            fsync=settings.wal_fsync,
+            group_commit_secs=settings.wal_group_commit_ms / 1000,
+        )
+
+    def path(self, route: str) -> str:
+        """where `route` (e.g. /replicate/batch) of this topic lives on other nodes"""
+        return route if self.name == DEFAULT_TOPIC else f"/topics/{self.name}{route}"
+
+    def logger(self, name: str) -> logging.Logger:
+        return logging.getLogger(name if self.name == DEFAULT_TOPIC else f"{name}:{self.name}")
+
+    async def start(self):
+        await self.replication_manager.start()
+        await self.anti_entropy.start()
+
+    async def close(self):
+        await self.store.close()
+
+
+def topic_param(topic: str = Path(..., description="Topic name")):
+    """declares the {topic} path parameter of the /topics/{topic}/... routes (docs + validation)"""
+
+
+def get_topic(request: Request) -> Topic:
+    """
+    route dependency: the topic of /topics/{topic}/..., the default one for the unprefixed routes
+    a topic served by another process is redirected to it when TOPIC_OWNERS knows the owner
+    """
+    from main import topics
+
+    name = request.path_params.get("topic", DEFAULT_TOPIC)
+    topic = topics.get(name)
+    if topic is not None:
+        return topic
+
+    owner = settings.topic_owners.get(name)
+    if owner is not None:
+        location = str(owner).rstrip("/") + request.url.path
+        if request.url.query:
+            location += "?" + request.url.query
+        raise HTTPException(status_code=307, headers={"Location": location})
+    raise HTTPException(status_code=404, detail=f"Topic {name} is not served by this node")
@@ -0,0 +1,339 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from app.entry import Entry
+
+log = logging.getLogger("WAL")
+
+# record = header + utf-8 content, crc32 covers everything after the crc field
+#   crc32 (I) | id (Q) | ts in micros since epoch (q) | content length (I)
+_RECORD = struct.Struct("<IQqI")
+# sparse index entry = (id, byte offset of that record inside the segment)
+_INDEX = struct.Struct("<QQ")
+
+
+def encode_record(entry: Entry) -> bytes:
+    data = entry.content.encode()
+    body = _RECORD.pack(0, entry.id, entry.ts_us, len(data))[4:] + data
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def iter_records(f: BinaryIO) -> Iterator[Tuple[int, int, Entry]]:
+    """
+    yields (offset, size, entry) until EOF or the first torn / corrupted record
+    """
+    offset = f.tell()
+    while True:
+        head = f.read(_RECORD.size)
+        if len(head) < _RECORD.size:
+            return
+        crc, msg_id, ts, length = _RECORD.unpack(head)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(head[4:] + data) != crc:
+            return
+        size = _RECORD.size + length
+        yield offset, size, Entry(msg_id, ts, data.decode())
+        offset += size
+
+
+class _Segment:
+    """
+    one append-only file `<first_id>.log` + its sparse index `<first_id>.idx`
+
+    the index is loaded lazily - old segments are only touched when someone reads from them
+    """
+
+    def __init__(self, directory: str, first_id: int) -> None:
+        self.first_id = first_id
+        base = os.path.join(directory, f"{first_id:020d}")
+        self.log_path = base + ".log"
+        self.idx_path = base + ".idx"
+        self._ids: Optional[List[int]] = None
+        self._offsets: Optional[List[int]] = None
+
+    def index(self) -> Tuple[List[int], List[int]]:
+        if self._ids is None or self._offsets is None:
+            ids, offsets = [], []
+            if os.path.exists(self.idx_path):
+                with open(self.idx_path, "rb") as f:
+                    raw = f.read()
+                usable = len(raw) - len(raw) % _INDEX.size  # drop a torn trailing entry
+                for msg_id, offset in _INDEX.iter_unpack(raw[:usable]):
+                    ids.append(msg_id)
+                    offsets.append(offset)
+            self._ids, self._offsets = ids, offsets
+        return self._ids, self._offsets
+
+    def add_index(self, msg_id: int, offset: int) -> None:
+        ids, offsets = self.index()
+        ids.append(msg_id)
+        offsets.append(offset)
+
+
+class SegmentedWAL:
+    """
+    Durable backend for LogStore: a directory of append-only segment files
+
+    - records are only appended, a new segment is started once the active one exceeds `segment_bytes`
+    - every `index_interval_bytes` a (id, offset) pair goes to the sparse index,
+      so reads seek close to the wanted id and only scan a few KB
+    - recovery reads the index of the LAST segment and scans just the unindexed tail,
+      restart time does not depend on how long the log is
+    - group commit: `append` only buffers, `sync` makes the caller wait for an fsync,
+      and every caller that arrives while an fsync is running shares the next one
+
+    IDs must be appended in increasing order (which is what both roles do anyway),
+    anti-entropy repairs of existing ids go to a small `repairs.dat` sidecar (same record format)
+    that is loaded at startup and applied on every read
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 64 * 1024 * 1024,
+        index_interval_bytes: int = 4096,
+        fsync: bool = True,
+        group_commit_secs: float = 0.0,
+    ) -> None:
+        self._dir = directory
+        self._segment_bytes = segment_bytes
+        self._index_interval = index_interval_bytes
+        self._fsync = fsync
+        self._group_commit_secs = group_commit_secs
+
+        self._segments: List[_Segment] = []
+        self._log_fh: Optional[BinaryIO] = None
+        self._idx_fh: Optional[BinaryIO] = None
+        self._size = 0  # bytes in the active segment
+        self._since_index = 0
+
+        self.last_id = 0
+        # group commit bookkeeping, sequence numbers of appended / fsynced records
+        self._written = 0
+        self._durable = 0
+        self._flushing: Optional[asyncio.Future] = None
+        # rolled segment handles (already fsynced by _roll), closed by the next sync: a flush running
+        # in a thread may still hold them
+        self._retired: List[BinaryIO] = []
+        # a segment was created since the last flush, its directory entry needs an fsync too
+        self._dir_dirty = False
+
+        # id -> repaired message, overrides what the segments say
+        self._repairs: Dict[int, Entry] = {}
+        self._repairs_path = os.path.join(directory, "repairs.dat")
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._load_repairs()
+
+    # ---- recovery ----
+
+    def _recover(self) -> None:
+        names = sorted(n for n in os.listdir(self._dir) if n.endswith(".log"))
+        self._segments = [_Segment(self._dir, int(n[:-4])) for n in names]
+        if not self._segments:
+            self._open_active(_Segment(self._dir, 1))
+            log.info(f"Empty WAL created at {self._dir}")
+            return
+
+        seg = self._segments[-1]
+        ids, offsets = seg.index()
+        file_size = os.path.getsize(seg.log_path)
+
+        # walk the tail starting at the last index entry that still points to a valid record
+        while True:
+            start = offsets[-1] if offsets else 0
+            last_id = seg.first_id - 1
+            end = start
+            with open(seg.log_path, "rb") as f:
+                f.seek(start)
+                for offset, size, msg in iter_records(f):
+                    last_id, end = msg.id, offset + size
+            if not offsets or end > start:
+                break
+            # the indexed record itself is torn, index got to disk before the data did
+            ids.pop()
+            offsets.pop()
+
+        dropped_index = os.path.exists(seg.idx_path) and os.path.getsize(
+            seg.idx_path
+        ) != len(ids) * _INDEX.size
+        if end < file_size:
+            log.warning(f"Truncating torn tail of {seg.log_path}: {file_size - end} bytes")
+            with open(seg.log_path, "r+b") as f:
+                f.truncate(end)
+        if dropped_index:
+            with open(seg.idx_path, "wb") as f:
+                f.write(b"".join(_INDEX.pack(i, o) for i, o in zip(ids, offsets)))
+
+        self.last_id = last_id
+        self._segments.pop()
+        self._open_active(seg)
+        self._since_index = end - (offsets[-1] if offsets else 0)
+        log.info(
+            f"Recovered WAL {self._dir}: {len(self._segments)} segments, last_id={last_id}"
+        )
+
+    def _open_active(self, seg: _Segment) -> None:
+        self._segments.append(seg)
+        self._dir_dirty |= not os.path.exists(seg.log_path)
+        self._log_fh = open(seg.log_path, "ab")
+        self._idx_fh = open(seg.idx_path, "ab")
+        self._size = self._log_fh.tell()
+        self._since_index = 0
+
+    def _roll(self, first_id: int) -> None:
+        assert self._log_fh is not None and self._idx_fh is not None
+        self._log_fh.flush()
+        self._idx_fh.flush()
+        # the old segment has to be complete on disk before the new one gets its first record:
+        # recovery only checks the last segment, a torn tail before it would leave a hole in the ids
+        # (blocking, but once per segment_bytes; the handles are closed by the next sync)
+        if self._fsync:
+            self._fsync_files([self._log_fh, self._idx_fh])
+        self._retired += [self._log_fh, self._idx_fh]
+        self._open_active(_Segment(self._dir, first_id))
+
+    # ---- writes ----
+
+    def append(self, msg: Entry) -> int:
+        """
+        buffer one record, returns its sequence number for `sync`
+        sync on purpose - it's called under the LogStore lock, ordering is decided here
+        """
+        if msg.id <= self.last_id:
+            raise ValueError(f"WAL append out of order: id={msg.id} <= {self.last_id}")
+        if self._size >= self._segment_bytes:
+            self._roll(msg.id)
+        assert self._log_fh is not None and self._idx_fh is not None
+
+        record = encode_record(msg)
+        if self._size == 0 or self._since_index >= self._index_interval:
+            self._idx_fh.write(_INDEX.pack(msg.id, self._size))
+            self._segments[-1].add_index(msg.id, self._size)
+            self._since_index = 0
+        self._log_fh.write(record)
+        self._size += len(record)
+        self._since_index += len(record)
+
+        self.last_id = msg.id
+        self._written += 1
+        return self._written
+
+    async def sync(self, seq: int) -> None:
+        """wait until record `seq` is durable, concurrent callers share a single fsync"""
+        while self._durable < seq:
+            if self._flushing is not None:
+                await asyncio.shield(self._flushing)
+                continue
+
+            fut = self._flushing = asyncio.get_running_loop().create_future()
+            try:
+                if self._group_commit_secs > 0:
+                    # give concurrent writers a moment to join this flush
+                    await asyncio.sleep(self._group_commit_secs)
+                upto = self._written
+                assert self._log_fh is not None and self._idx_fh is not None
+                self._log_fh.flush()
+                self._idx_fh.flush()
+                retired, self._retired = self._retired, []
+                dir_dirty, self._dir_dirty = self._dir_dirty, False
+                if self._fsync:
+                    await asyncio.to_thread(
+                        self._fsync_files, [self._log_fh, self._idx_fh]
+                    )
+                    if dir_dirty:
+                        await asyncio.to_thread(self._fsync_dir)
+                for fh in retired:
+                    fh.close()
+                self._durable = upto
+                fut.set_result(None)
+            except BaseException as e:
+                fut.set_exception(e)
+                fut.exception()  # mark as retrieved, the leader re-raises below
+                raise
+            finally:
+                self._flushing = None
+
+    @staticmethod
+    def _fsync_files(files: List[BinaryIO]) -> None:
+        # data first, then index, a torn index entry is handled during recovery anyway
+        for fh in files:
+            os.fsync(fh.fileno())
+
+    def _fsync_dir(self) -> None:
+        # a new file's data can be durable while its name isn't, until the directory is synced
+        fd = os.open(self._dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    async def close(self) -> None:
+        await self.sync(self._written)
+        for fh in (self._log_fh, self._idx_fh):
+            if fh is not None:
+                fh.close()
+        self._log_fh = self._idx_fh = None
+
+    # ---- repairs ----
+
+    def _load_repairs(self) -> None:
+        if not os.path.exists(self._repairs_path):
+            return
+        end = 0
+        with open(self._repairs_path, "rb") as f:
+            for offset, size, msg in iter_records(f):
+                self._repairs[msg.id] = msg
+                end = offset + size
+        if end < os.path.getsize(self._repairs_path):
+            log.warning(f"Truncating torn tail of {self._repairs_path} at {end}")
+            os.truncate(self._repairs_path, end)
+
+    def repair(self, msg: Entry) -> None:
+        """blocking (to_thread), durable before it returns - repairs are rare"""
+        created = not os.path.exists(self._repairs_path)
+        with open(self._repairs_path, "ab") as f:
+            f.write(encode_record(msg))
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        if created and self._fsync:
+            self._fsync_dir()
+        self._repairs[msg.id] = msg
+
+    # ---- reads ----
+
+    def read(self, start_id: int, end_id: int) -> List[Entry]:
+        """
+        blocking read of [start_id, end_id), meant to run in a thread (asyncio.to_thread)
+        only for records that are already flushed - LogStore calls it for the recovered prefix
+        """
+        out = self._read_segments(start_id, end_id)
+        if self._repairs:
+            out = [self._repairs.get(msg.id, msg) for msg in out]
+        return out
+
+    def _read_segments(self, start_id: int, end_id: int) -> List[Entry]:
+        out: List[Entry] = []
+        firsts = [s.first_id for s in self._segments]
+        i = max(bisect_right(firsts, start_id) - 1, 0)
+
+        for seg in self._segments[i:]:
+            if seg.first_id >= end_id:
+                break
+            ids, offsets = seg.index()
+            j = bisect_right(ids, start_id) - 1
+            with open(seg.log_path, "rb") as f:
+                f.seek(offsets[j] if j >= 0 else 0)
+                for _, _, msg in iter_records(f):
+                    if msg.id >= end_id:
+                        return out
+                    if msg.id >= start_id:
+                        out.append(msg)
+        return out
@@ -0,0 +1,48 @@
+import struct
+from typing import List
+
+from app.entry import Entry
+
+# binary replication body = message count (I) + per message:
+#   id (Q) | ts in micros since epoch (q) | content length (I) | utf-8 content
+# no checksum, unlike WAL records / snapshot chunks: TCP + HTTP framing already cover a single request
+_COUNT = struct.Struct("<I")
+_HEAD = struct.Struct("<QqI")
+
+MEDIA_TYPE = "application/x-replog-batch"
+
+
+def encode(entries: List[Entry]) -> bytes:
+    parts = [_COUNT.pack(len(entries))]
+    for entry in entries:
+        data = entry.content.encode()
+        parts.append(_HEAD.pack(entry.id, entry.ts_us, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode(buf: bytes) -> List[Entry]:
+    """raises ValueError on a truncated / malformed body"""
+    if len(buf) < _COUNT.size:
+        raise ValueError("missing message count")
+    (count,) = _COUNT.unpack_from(buf)
+
+    entries: List[Entry] = []
+    pos = _COUNT.size
+    for _ in range(count):
+        if pos + _HEAD.size > len(buf):
+            raise ValueError(f"truncated after {len(entries)} of {count} messages")
+        msg_id, ts, length = _HEAD.unpack_from(buf, pos)
+        pos += _HEAD.size
+        if msg_id < 1 or pos + length > len(buf):
+            raise ValueError(f"malformed message #{len(entries)} (id={msg_id})")
+        entries.append(Entry(msg_id, ts, buf[pos : pos + length].decode()))
+        pos += length
+    if pos != len(buf):
+        raise ValueError(f"{len(buf) - pos} trailing bytes")
+    return entries
+
+
+def accepts(accept_header: str) -> bool:
+    """does an Accept header ask for the binary format"""
+    return any(part.split(";")[0].strip() == MEDIA_TYPE for part in accept_header.split(","))
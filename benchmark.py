@@ -0,0 +1,402 @@
+"""
+Benchmark: starts a master and N secondaries as local subprocesses, drives write / read workloads
+against them and writes the results as JSON (compare two files to catch regressions between releases)
+
+    python benchmark.py --secondaries 2 --w 1 3 --duration 10 --output bench.json
+
+measured:
+- closed-loop (fixed number of clients, each sends its next request after the previous answer) and
+  open-loop (fixed request rate, latency counted from when the request was due, so a slow server
+  can't hide its queueing) writes for every w, and reads spread over all the nodes;
+  throughput + p50/p99/p999 latency, errors by status code
+- memory per message (RSS growth of every node after loading `--memory-messages`)
+- catch-up time of a secondary restarted while `--catchup-messages` were written without it
+
+the load comes from `--load-procs` processes, a single python client would saturate before the cluster
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s"
+)
+log = logging.getLogger("BENCH")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per request otherwise
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Node:
+    """one uvicorn process of the cluster"""
+
+    def __init__(self, role: str, port: int, env: Dict[str, str], data_dir: str, log_dir: Optional[str] = None):
+        self.role = role
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = dict(os.environ, ROLE=role, PORT=str(port), DATA_DIR=data_dir, **env)
+        self.log_path = os.path.join(log_dir, f"{role}-{port}.log") if log_dir else None
+        self.proc: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 30.0):
+        output = open(self.log_path, "a") if self.log_path else subprocess.DEVNULL
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(self.port), "--log-level", "warning"],
+            cwd=ROOT,
+            env=self.env,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.role} on {self.port} exited with {self.proc.returncode}")
+            try:
+                if httpx.get(f"{self.url}/health").status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"{self.role} on {self.port} isn't ready after {timeout}s")
+
+    def stop(self, timeout: float = 15.0):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.send_signal(signal.SIGINT)  # graceful, flushes the WAL
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def rss_bytes(self) -> Optional[int]:
+        """resident memory of the process, None where /proc isn't available"""
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def last_id(self) -> int:
+        return httpx.get(f"{self.url}/health", timeout=10).json().get("last_id") or 0
+
+
+# -- load generation, runs in the load processes --
+
+
+async def _send(client: httpx.AsyncClient, spec: dict, rng: random.Random):
+    if spec["kind"] == "write":
+        return await client.post(
+            f"{spec['urls'][0]}/messages", json={"content": spec["payload"], "w": spec["w"]}
+        )
+    after = rng.randint(0, max(spec["last_id"] - spec["read_limit"], 0))
+    return await client.get(
+        f"{rng.choice(spec['urls'])}/messages", params={"after": after, "limit": spec["read_limit"]}
+    )
+
+
+async def _timed(client, spec, rng, started: float, latencies: List[float], errors: Dict[str, int]):
+    try:
+        resp = await _send(client, spec, rng)
+        if resp.status_code != 200:
+            errors[str(resp.status_code)] = errors.get(str(resp.status_code), 0) + 1
+            return
+    except httpx.TimeoutException:
+        errors["timeout"] = errors.get("timeout", 0) + 1
+        return
+    except httpx.HTTPError as e:
+        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+        return
+    latencies.append(time.monotonic() - started)
+
+
+async def _closed_loop(spec: dict, latencies, errors):
+    rng = random.Random()
+    deadline = time.monotonic() + spec["duration"]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=spec["timeout"], limits=limits) as client:
+
+        async def client_loop():
+            while time.monotonic() < deadline:
+                await _timed(client, spec, rng, time.monotonic(), latencies, errors)
+
+        await asyncio.gather(*(client_loop() for _ in range(spec["concurrency"])))
+
+
+async def _open_loop(spec: dict, latencies, errors):
+    rng = random.Random()
+    interval = 1 / spec["rate"]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=spec["timeout"], limits=limits) as client:
+        start = time.monotonic()
+        tasks = []
+        for i in range(int(spec["duration"] * spec["rate"])):
+            due = start + i * interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # latency from `due`, not from when the request actually went out (coordinated omission)
+            tasks.append(asyncio.create_task(_timed(client, spec, rng, due, latencies, errors)))
+        await asyncio.gather(*tasks)
+
+
+def _load_worker(spec: dict) -> dict:
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    run = _closed_loop if spec["mode"] == "closed" else _open_loop
+    asyncio.run(run(spec, latencies, errors))
+    return {"latencies": latencies, "errors": errors}
+
+
+# -- orchestration --
+
+
+def _percentile(ordered: List[float], q: float) -> Optional[float]:
+    """nearest-rank percentile of an already sorted list, in ms"""
+    if not ordered:
+        return None
+    rank = max(int(len(ordered) * q + 0.999999) - 1, 0)
+    return round(ordered[min(rank, len(ordered) - 1)] * 1000, 3)
+
+
+def run_workload(pool, procs: int, spec: dict) -> dict:
+    """split `spec` over the load processes, merge what they measured"""
+    if spec["mode"] == "closed":
+        procs = min(procs, spec["concurrency"])
+        shares = [spec["concurrency"] // procs + (i < spec["concurrency"] % procs) for i in range(procs)]
+        specs = [dict(spec, concurrency=share) for share in shares]
+    else:
+        specs = [dict(spec, rate=spec["rate"] / procs) for _ in range(procs)]
+
+    started = time.monotonic()
+    results = pool.map(_load_worker, specs)
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(lat for r in results for lat in r["latencies"])
+    errors: Dict[str, int] = {}
+    for r in results:
+        for key, count in r["errors"].items():
+            errors[key] = errors.get(key, 0) + count
+
+    result = {
+        key: spec[key] for key in ("kind", "mode", "w", "concurrency", "rate") if spec.get(key) is not None
+    }
+    result.update(
+        {
+            "requests": len(latencies) + sum(errors.values()),
+            "ok": len(latencies),
+            "errors": errors,
+            "elapsed_secs": round(elapsed, 3),
+            "throughput_rps": round(len(latencies) / elapsed, 1),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                "p50": _percentile(latencies, 0.50),
+                "p99": _percentile(latencies, 0.99),
+                "p999": _percentile(latencies, 0.999),
+                "max": _percentile(latencies, 1.0),
+            },
+        }
+    )
+    log.info(
+        f"{spec['kind']} {spec['mode']} w={spec.get('w')}: {result['throughput_rps']} req/s, "
+        f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms, errors {errors}"
+    )
+    return result
+
+
+def wait_for_sync(master: Node, secondaries: List[Node], timeout: float) -> bool:
+    """until every secondary has the master's last id, so a workload doesn't pay for the previous one's backlog"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        target = master.last_id()
+        if all(s.last_id() >= target for s in secondaries):
+            return True
+        time.sleep(0.1)
+    log.warning(f"secondaries still behind after {timeout}s")
+    return False
+
+
+def load_messages(master: Node, count: int, payload: str, batch: int = 1000):
+    with httpx.Client(timeout=60) as client:
+        for first in range(0, count, batch):
+            contents = [payload] * min(batch, count - first)
+            resp = client.post(f"{master.url}/messages/batch", json={"contents": contents, "w": 1})
+            resp.raise_for_status()
+
+
+def measure_memory(master: Node, secondaries: List[Node], args, payload: str) -> dict:
+    nodes = [master] + secondaries
+    before = [n.rss_bytes() for n in nodes]
+    load_messages(master, args.memory_messages, payload)
+    wait_for_sync(master, secondaries, args.sync_timeout)
+    after = [n.rss_bytes() for n in nodes]
+
+    per_node = {}
+    for node, b, a in zip(nodes, before, after):
+        per_node[node.url] = {
+            "rss_before": b,
+            "rss_after": a,
+            "bytes_per_message": round((a - b) / args.memory_messages, 1) if a is not None and b is not None else None,
+        }
+    log.info(f"memory per message: { {url: n['bytes_per_message'] for url, n in per_node.items()} }")
+    return {"messages": args.memory_messages, "payload_bytes": args.payload_bytes, "nodes": per_node}
+
+
+def measure_catch_up(master: Node, secondary: Node, args, payload: str) -> dict:
+    secondary.stop()
+    load_messages(master, args.catchup_messages, payload)
+    target = master.last_id()
+
+    started = time.monotonic()
+    secondary.start()
+    ready = time.monotonic()
+    behind = target - secondary.last_id()
+    caught_up = None
+    while time.monotonic() - ready < args.sync_timeout:
+        if secondary.last_id() >= target:
+            caught_up = time.monotonic()
+            break
+        time.sleep(0.05)
+
+    result = {
+        "node": secondary.url,
+        "messages_written_while_down": args.catchup_messages,
+        "messages_behind_at_start": behind,
+        "startup_secs": round(ready - started, 3),
+        "catch_up_secs": round(caught_up - ready, 3) if caught_up is not None else None,
+    }
+    log.info(f"catch-up: {behind} messages behind, in sync after {result['catch_up_secs']}s")
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--secondaries", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=8100, help="master port, secondaries take the next ones")
+    parser.add_argument("--repl-delay", type=float, default=0.0, help="REPL_DELAY_SECS of the secondaries")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra setting for every node")
+    parser.add_argument("--w", type=int, nargs="+", help="write concerns to run (default: 1 and all nodes)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per workload")
+    parser.add_argument("--concurrency", type=int, default=64, help="clients of the closed-loop workloads")
+    parser.add_argument("--rate", type=float, default=1000.0, help="requests/s of the open-loop workloads")
+    parser.add_argument("--modes", nargs="+", choices=["closed", "open"], default=["closed", "open"])
+    parser.add_argument("--load-procs", type=int, default=max(multiprocessing.cpu_count() // 2, 1))
+    parser.add_argument("--payload-bytes", type=int, default=100)
+    parser.add_argument("--read-limit", type=int, default=100, help="page size of the reads")
+    parser.add_argument("--request-timeout", type=float, default=30.0)
+    parser.add_argument("--memory-messages", type=int, default=100_000, help="0 skips the memory measurement")
+    parser.add_argument("--catchup-messages", type=int, default=50_000, help="0 skips the catch-up measurement")
+    parser.add_argument("--sync-timeout", type=float, default=120.0)
+    parser.add_argument("--node-log-dir", help="keep the nodes' output there (discarded by default)")
+    parser.add_argument("--output", default="benchmark.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    payload = "x" * args.payload_bytes
+    data_root = tempfile.mkdtemp(prefix="replog-bench-")
+    if args.node_log_dir:
+        os.makedirs(args.node_log_dir, exist_ok=True)
+
+    extra = dict(kv.split("=", 1) for kv in args.env)
+    sec_ports = [args.base_port + i + 1 for i in range(args.secondaries)]
+    master = Node(
+        "master",
+        args.base_port,
+        {"SECONDARIES": json.dumps([f"http://127.0.0.1:{p}" for p in sec_ports]), **extra},
+        os.path.join(data_root, "master"),
+        args.node_log_dir,
+    )
+    secondaries = [
+        Node(
+            "secondary",
+            port,
+            {"MASTER_URL": master.url, "REPL_DELAY_SECS": str(args.repl_delay), **extra},
+            os.path.join(data_root, f"secondary{port}"),
+            args.node_log_dir,
+        )
+        for port in sec_ports
+    ]
+    write_concerns = args.w or [1, args.secondaries + 1]
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "args": vars(args),
+        },
+        "workloads": [],
+    }
+
+    try:
+        for node in secondaries + [master]:
+            node.start()
+        # the master has to see the secondaries healthy before w>1 writes are admitted
+        wait_for_sync(master, secondaries, args.sync_timeout)
+
+        if args.memory_messages > 0:
+            report["memory"] = measure_memory(master, secondaries, args, payload)
+
+        base = {
+            "payload": payload,
+            "duration": args.duration,
+            "timeout": args.request_timeout,
+            "read_limit": args.read_limit,
+        }
+        with multiprocessing.Pool(args.load_procs) as pool:
+            for mode in args.modes:
+                load = {"mode": mode, "concurrency": args.concurrency} if mode == "closed" else {"mode": mode, "rate": args.rate}
+                for w in write_concerns:
+                    spec = dict(base, **load, kind="write", w=w, urls=[master.url])
+                    report["workloads"].append(run_workload(pool, args.load_procs, spec))
+                    wait_for_sync(master, secondaries, args.sync_timeout)
+
+                urls = [master.url] + [s.url for s in secondaries]
+                spec = dict(base, **load, kind="read", urls=urls, last_id=master.last_id())
+                report["workloads"].append(run_workload(pool, args.load_procs, spec))
+
+        if args.catchup_messages > 0 and secondaries:
+            report["catch_up"] = measure_catch_up(master, secondaries[-1], args, payload)
+    finally:
+        for node in [master] + secondaries:
+            node.stop()
+        shutil.rmtree(data_root, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log.info(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
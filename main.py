@@ -1,18 +1,17 @@
 import logging
+import uuid
 
 # found the info from the Ramalho 2022 book
 from contextlib import (
     asynccontextmanager,  # that one is kinda cool
 )
-from typing import Dict
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 
-from app.pydantic_models import Message
 from app.routers import health, messages, replication
 from app.services.health_tracker import health_tracker
-from app.services.replication_manager import replication_manager
-from app.storage import LogStore
+from app.services.transport import transport
+from app.topics import Topic, topic_param
 from settings import settings
 
 logging.basicConfig(
@@ -24,9 +23,14 @@ log = logging.getLogger(settings.role.upper())
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await transport.start()
     await health_tracker.start()
-    await replication_manager.start()
+    for topic in topics.values():
+        await topic.start()
     yield
+    await transport.close()
+    for topic in topics.values():
+        await topic.close()
 
 
 app = FastAPI(
@@ -44,12 +48,15 @@ app = FastAPI(
 
 
 app.include_router(health.router)
-app.include_router(messages.router)
-app.include_router(replication.router)
+# unprefixed routes serve the "default" topic, /topics/{topic}/... any other one
+for router in (messages.router, replication.router):
+    app.include_router(router)
+    app.include_router(router, prefix="/topics/{topic}", dependencies=[Depends(topic_param)])
 
 
-store = LogStore()
+# independent logs served by this process, each with its own store and replication stream
+topics = {name: Topic(name) for name in settings.topics}
 
-# track pending messages that arrived out of order on secondaries
-# maps message_id -> Message waiting to be committed
-pending_buffer: Dict[int, Message] = {}
+# identity of this process, reported in /health and replication ACKs,
+# a new value tells the master that whatever it knew about this node's progress is stale
+incarnation = uuid.uuid4().hex
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List, Optional
 
 from pydantic import AnyHttpUrl, BaseSettings, Field
 
@@ -10,12 +10,69 @@ class Settings(BaseSettings):
     secondaries: List[AnyHttpUrl] = Field(
         default_factory=list, env="SECONDARIES"
     )  # supports JSON
+    # secondaries only: where to pull missing ranges from (gap catch-up), None = push only
+    master_url: Optional[AnyHttpUrl] = Field(default=None, env="MASTER_URL")
+    # topics (independent logs) served by this process, JSON list; the unprefixed routes are "default"
+    topics: List[str] = Field(default=["default"], env="TOPICS")
+    # topic -> base url of the process serving it, requests for those are redirected there
+    topic_owners: Dict[str, AnyHttpUrl] = Field(default={}, env="TOPIC_OWNERS")
+    gap_pull_delay_ms: float = Field(default=200.0, env="GAP_PULL_DELAY_MS")
 
     repl_delay_secs: float = Field(default=10.0, env="REPL_DELAY_SECS")
     repl_timeout_secs: float = Field(
         default=30.0, env="REPL_TIMEOUT_SECS"
     )  # changed to 30 secs as suggested
     repl_retries: int = Field(default=4, env="REPL_RETRIES")
+    repl_batch_size: int = Field(
+        default=500, env="REPL_BATCH_SIZE"
+    )  # max messages per /replicate/batch request
+    repl_max_inflight: int = Field(
+        default=4, env="REPL_MAX_INFLIGHT"
+    )  # batches on the wire per secondary (pipelining)
+    repl_max_inflight_bytes: int = Field(
+        default=8 * 1024 * 1024, env="REPL_MAX_INFLIGHT_BYTES"
+    )  # memory ceiling for outbound replication data per secondary
+
+    # retries: exponential backoff with jitter, base * 2^(failures - 1) capped at max
+    repl_backoff_base_secs: float = Field(default=0.2, env="REPL_BACKOFF_BASE_SECS")
+    repl_backoff_max_secs: float = Field(default=10.0, env="REPL_BACKOFF_MAX_SECS")
+
+    # circuit breaker per secondary, failed batches in a row before it opens / secs before a trial
+    breaker_failure_threshold: int = Field(default=3, env="BREAKER_FAILURE_THRESHOLD")
+    breaker_reset_secs: float = Field(default=5.0, env="BREAKER_RESET_SECS")
+    write_concern_timeout_ms: Optional[float] = Field(
+        default=None, env="WRITE_CONCERN_TIMEOUT_MS"
+    )  # default deadline when a request has no timeout_ms, None = wait forever
+
+    # snapshot bootstrap for secondaries this far behind (0 = always batches), ids per chunk
+    snapshot_threshold: int = Field(default=100_000, env="SNAPSHOT_THRESHOLD")
+    snapshot_chunk_size: int = Field(default=10_000, env="SNAPSHOT_CHUNK_SIZE")
+
+    # anti-entropy: range-hash comparison of every secondary against the master, 0 secs = disabled
+    anti_entropy_interval_secs: float = Field(default=60.0, env="ANTI_ENTROPY_INTERVAL_SECS")
+    anti_entropy_leaf_size: int = Field(default=1024, env="ANTI_ENTROPY_LEAF_SIZE")  # ids per leaf
+    anti_entropy_fanout: int = Field(default=16, env="ANTI_ENTROPY_FANOUT")
+
+    # admission control on the master write path (0 disables a limit), rejected writes get 429
+    admission_max_waiters: int = Field(default=1000, env="ADMISSION_MAX_WAITERS")
+    admission_max_lag: int = Field(default=100_000, env="ADMISSION_MAX_LAG")
+    admission_retry_after_max_secs: float = Field(
+        default=30.0, env="ADMISSION_RETRY_AFTER_MAX_SECS"
+    )
+
+    # pooled connections per secondary (shared by replication, heartbeats and catch-up)
+    repl_pool_size: int = Field(default=10, env="REPL_POOL_SIZE")
+    repl_keepalive_secs: float = Field(default=30.0, env="REPL_KEEPALIVE_SECS")
+    repl_http2: bool = Field(default=False, env="REPL_HTTP2")  # needs `h2` + https
+    # "binary" (app/wire.py, falls back to json per secondary that doesn't accept it) or "json"
+    repl_wire_format: str = Field(default="binary", env="REPL_WIRE_FORMAT")
+    # zstd (needs `zstandard`, else deflate) / deflate / none, only bodies of at least min_bytes
+    repl_compression: str = Field(default="zstd", env="REPL_COMPRESSION")
+    repl_compression_min_bytes: int = Field(default=1024, env="REPL_COMPRESSION_MIN_BYTES")
+    # 0 = master pushes to every secondary, 1 = chain, k = tree where every node forwards to k others
+    repl_fanout: int = Field(default=0, env="REPL_FANOUT")
+    # how long a node holds its upstream's progress long-poll when nothing moves
+    repl_progress_wait_secs: float = Field(default=10.0, env="REPL_PROGRESS_WAIT_SECS")
 
     # heartbeat conf
     heartbeat_interval_secs: float = Field(default=5.0, env="HEARTBEAT_INTERVAL_SECS")
@@ -26,6 +83,39 @@ class Settings(BaseSettings):
     unhealthy_threshold: int = Field(
         default=4, env="UNHEALTHY_THRESHOLD"
     )  # missed heartbeats before unhealthy
+    # phi accrual detector, phi = -log10(chance that the secondary is fine after all)
+    phi_suspect_threshold: float = Field(default=3.0, env="PHI_SUSPECT_THRESHOLD")
+    phi_unhealthy_threshold: float = Field(default=8.0, env="PHI_UNHEALTHY_THRESHOLD")
+    phi_window: int = Field(default=100, env="PHI_WINDOW")  # heartbeat intervals remembered
+    phi_min_std_secs: float = Field(default=0.5, env="PHI_MIN_STD_SECS")
+
+    # write micro-batching (group commit) on the master, 0 ms window = disabled
+    write_batch_window_ms: float = Field(default=0.0, env="WRITE_BATCH_WINDOW_MS")
+    write_batch_max: int = Field(default=256, env="WRITE_BATCH_MAX")
+
+    messages_batch_max: int = Field(
+        default=10_000, env="MESSAGES_BATCH_MAX"
+    )  # max contents per POST /messages/batch
+
+    messages_page_max: int = Field(
+        default=10_000, env="MESSAGES_PAGE_MAX"
+    )  # upper bound for GET /messages?limit=
+    stream_keepalive_secs: float = Field(
+        default=15.0, env="STREAM_KEEPALIVE_SECS"
+    )  # idle SSE subscribers get a comment line this often
+
+    # storage conf, "memory" keeps the old behaviour, "wal" persists the log under data_dir
+    storage_backend: str = Field(default="memory", env="STORAGE_BACKEND")
+    data_dir: str = Field(default="data", env="DATA_DIR")
+    wal_segment_bytes: int = Field(default=64 * 1024 * 1024, env="WAL_SEGMENT_BYTES")
+    wal_index_interval_bytes: int = Field(default=4096, env="WAL_INDEX_INTERVAL_BYTES")
+    wal_fsync: bool = Field(default=True, env="WAL_FSYNC")
+    wal_group_commit_ms: float = Field(
+        default=0.0, env="WAL_GROUP_COMMIT_MS"
+    )  # extra wait before fsync so more commits share it
+    # in-memory contents compressed in blocks of `store_compression_block` messages: zstd / deflate / none
+    store_compression: str = Field(default="none", env="STORE_COMPRESSION")
+    store_compression_block: int = Field(default=1024, env="STORE_COMPRESSION_BLOCK")
 
     # pylance fights here, just ignore
     class Config:  # type: ignore
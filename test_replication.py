@@ -0,0 +1,118 @@
+"""
+Unit tests for the replication helpers: ACK tracking and the wire / snapshot codecs, `python -m pytest`
+"""
+
+import asyncio
+import struct
+
+import pytest
+
+from app import wire
+from app.entry import Entry
+from app.services.replication_manager import AckWindow, _runs, _subtract
+from app.snapshot import encode_chunk, read_chunks
+
+
+def entries(first: int, last: int):
+    return [Entry(i, i * 1000, f"m{i} ✓") for i in range(first, last + 1)]
+
+
+# ---- ACK tracking ----
+
+
+def test_ack_window_folds_out_of_order_runs():
+    window = AckWindow()
+    window.add(5, 6)
+    window.add(9, 9)
+    assert window.through == 0
+    assert list(window.gaps(10)) == [(1, 4), (7, 8), (10, 10)]
+    assert window.count(10) == 3
+    assert window.covers(5, 6) and not window.covers(5, 7)
+
+    window.add(1, 4)
+    assert window.through == 6
+    window.add(7, 8)
+    assert window.through == 9
+    assert list(window.gaps(12)) == [(10, 12)]
+    assert window.covers(1, 9) and window.count(20) == 9
+
+
+def test_ack_window_ignores_already_acked():
+    window = AckWindow()
+    window.add(1, 10)
+    window.add(3, 4)
+    window.add(8, 12)
+    assert window.through == 12
+    assert list(window.gaps(12)) == []
+
+
+def test_runs():
+    assert list(_runs([8, 1, 2, 3, 7])) == [(1, 3), (7, 8)]
+    assert list(_runs([])) == []
+
+
+def test_subtract():
+    assert _subtract([(1, 10)], [(3, 4), (8, 12)]) == [(1, 2), (5, 7)]
+    assert _subtract([(1, 5), (10, 20)], [(1, 5), (15, 15)]) == [(10, 14), (16, 20)]
+    assert _subtract([(1, 5)], []) == [(1, 5)]
+
+
+# ---- binary wire format ----
+
+
+def test_wire_roundtrip():
+    msgs = entries(1, 5) + [Entry(6, -1, "")]
+    assert wire.decode(wire.encode(msgs)) == msgs
+    assert wire.decode(wire.encode([])) == []
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"",
+        struct.pack("<I", 1),  # count without a message
+        struct.pack("<I", 1) + struct.pack("<QqI", 1, 0, 10) + b"short",
+        struct.pack("<I", 1) + struct.pack("<QqI", 0, 0, 0),  # id 0
+        wire.encode(entries(1, 1)) + b"x",  # trailing bytes
+        struct.pack("<I", 1) + struct.pack("<QqI", 1, 0, 2) + b"\xff\xfe",  # not utf-8
+    ],
+)
+def test_wire_decode_rejects_malformed(body):
+    with pytest.raises(ValueError):
+        wire.decode(body)
+
+
+def test_wire_accepts():
+    assert wire.accepts(f"application/json, {wire.MEDIA_TYPE};q=0.9")
+    assert not wire.accepts("application/json")
+
+
+# ---- snapshot chunks ----
+
+
+async def stream(data: bytes, step: int):
+    for i in range(0, len(data), step):
+        yield data[i : i + step]
+
+
+async def collect(data: bytes, step: int = 7):
+    return [msgs async for msgs in read_chunks(stream(data, step))]
+
+
+def test_snapshot_roundtrip_any_split():
+    data = encode_chunk(entries(1, 10)) + encode_chunk(entries(11, 12))
+    for step in (1, 7, len(data)):
+        assert asyncio.run(collect(data, step)) == [entries(1, 10), entries(11, 12)]
+
+
+def test_snapshot_truncated():
+    data = encode_chunk(entries(1, 10))
+    with pytest.raises(ValueError, match="truncated"):
+        asyncio.run(collect(data[:-3]))
+
+
+def test_snapshot_checksum_mismatch():
+    data = bytearray(encode_chunk(entries(1, 10)))
+    data[-1] ^= 0xFF
+    with pytest.raises(ValueError, match="checksum"):
+        asyncio.run(collect(bytes(data)))
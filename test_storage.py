@@ -0,0 +1,182 @@
+"""
+Unit tests for the on-disk log (SegmentedWAL) and LogStore recovery, `python -m pytest`
+"""
+
+import asyncio
+import os
+import threading
+
+import pytest
+
+from app.entry import Entry
+from app.range_hash import RangeHashIndex, combine, entry_hash
+from app.storage import LogStore
+from app.wal import SegmentedWAL
+
+
+def entries(first: int, last: int):
+    # fixed width, so every record has the same size
+    return [Entry(i, i * 1000, f"m{i:04d}") for i in range(first, last + 1)]
+
+
+def write(wal: SegmentedWAL, msgs):
+    async def run():
+        seq = 0
+        for msg in msgs:
+            seq = wal.append(msg)
+        await wal.sync(seq)
+        await wal.close()
+
+    asyncio.run(run())
+
+
+def segment_files(directory, suffix):
+    return sorted(os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(suffix))
+
+
+# ---- SegmentedWAL ----
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    write(SegmentedWAL(str(tmp_path)), entries(1, 10))
+    (log_path,) = segment_files(tmp_path, ".log")
+    size = os.path.getsize(log_path)
+    with open(log_path, "ab") as f:
+        f.write(b"\x01\x02\x03 half a record")
+
+    wal = SegmentedWAL(str(tmp_path))
+    assert wal.last_id == 10
+    assert os.path.getsize(log_path) == size
+    write(wal, entries(11, 11))
+    assert SegmentedWAL(str(tmp_path)).read(1, 20) == entries(1, 11)
+
+
+def test_index_pointing_past_eof_is_rewritten(tmp_path):
+    # an index entry every record, then the data loses its last records (index hit the disk first)
+    write(SegmentedWAL(str(tmp_path), index_interval_bytes=1), entries(1, 20))
+    (log_path,) = segment_files(tmp_path, ".log")
+    (idx_path,) = segment_files(tmp_path, ".idx")
+    record_size = os.path.getsize(log_path) // 20
+    os.truncate(log_path, record_size * 15 + 3)
+
+    wal = SegmentedWAL(str(tmp_path), index_interval_bytes=1)
+    assert wal.last_id == 15
+    assert os.path.getsize(log_path) == record_size * 15
+    assert os.path.getsize(idx_path) == 15 * 16
+    assert wal.read(1, 30) == entries(1, 15)
+
+
+def test_reads_across_segments(tmp_path):
+    write(SegmentedWAL(str(tmp_path), segment_bytes=200, index_interval_bytes=64), entries(1, 60))
+    assert len(segment_files(tmp_path, ".log")) > 3
+
+    wal = SegmentedWAL(str(tmp_path), segment_bytes=200, index_interval_bytes=64)
+    assert wal.last_id == 60
+    assert wal.read(1, 61) == entries(1, 60)
+    assert wal.read(17, 44) == entries(17, 43)
+    assert wal.read(60, 100) == entries(60, 60)
+    assert wal.read(61, 100) == []
+
+
+def test_repairs_are_replayed(tmp_path):
+    write(SegmentedWAL(str(tmp_path)), entries(1, 10))
+    wal = SegmentedWAL(str(tmp_path))
+    wal.repair(Entry(5, 5000, "fixed"))
+    asyncio.run(wal.close())
+    with open(tmp_path / "repairs.dat", "ab") as f:
+        f.write(b"torn")
+
+    wal = SegmentedWAL(str(tmp_path))
+    assert wal.read(4, 7) == [entries(4, 4)[0], Entry(5, 5000, "fixed"), entries(6, 6)[0]]
+    assert os.path.getsize(tmp_path / "repairs.dat") == 24 + len("fixed")  # torn tail dropped
+
+
+def test_out_of_order_append_is_rejected(tmp_path):
+    wal = SegmentedWAL(str(tmp_path))
+    wal.append(Entry(1, 0, "a"))
+    with pytest.raises(ValueError):
+        wal.append(Entry(1, 0, "b"))
+
+
+# ---- LogStore ----
+
+
+def test_logstore_recovers_from_wal(tmp_path):
+    async def run():
+        store = LogStore(SegmentedWAL(str(tmp_path), segment_bytes=256), hash_leaf_size=8)
+        await store.append_many([f"m{i}" for i in range(1, 41)])
+        written = await store.tail(0)
+        await store.close()
+
+        store = LogStore(SegmentedWAL(str(tmp_path), segment_bytes=256), hash_leaf_size=8)
+        assert store.last_id() == 40
+        assert await store.tail(0) == written
+        # recovered prefix (disk) + new entries (memory) read as one range
+        await store.commit_many([Entry(41, 1, "new")])
+        assert await store.range(39, 42) == written[38:] + [Entry(41, 1, "new")]
+
+        # the lazily hashed prefix gives the same hashes as a store that never restarted
+        fresh = LogStore(hash_leaf_size=8)
+        await fresh.commit_many(written + [Entry(41, 1, "new")])
+        for lo, hi in [(1, 41), (3, 17), (9, 16), (40, 41)]:
+            assert await store.range_hash(lo, hi) == await fresh.range_hash(lo, hi)
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_logstore_hides_entries_until_fsynced(tmp_path):
+    release = threading.Event()
+
+    async def run():
+        wal = SegmentedWAL(str(tmp_path))
+        fsync = wal._fsync_files
+        wal._fsync_files = lambda files: (release.wait(5), fsync(files))
+        store = LogStore(wal)
+
+        pending = asyncio.create_task(store.append_many(["a", "b"]))
+        await asyncio.sleep(0.05)
+        assert store.last_id() == 0
+        assert await store.tail(0) == []
+
+        release.set()
+        await pending
+        assert [e.content for e in await store.tail(0)] == ["a", "b"]
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_commit_many_rejects_gaps():
+    async def run():
+        store = LogStore()
+        await store.commit_many(entries(1, 3))
+        with pytest.raises(ValueError):
+            await store.commit_many(entries(5, 6))
+        assert store.last_id() == 3
+
+    asyncio.run(run())
+
+
+# ---- RangeHashIndex ----
+
+
+def test_range_hash_leaves():
+    index = RangeHashIndex(leaf_size=4)
+    for msg in entries(1, 10):
+        index.add(msg)
+
+    assert index.full_leaves(1, 8) == range(0, 2)
+    assert index.full_leaves(2, 8) == range(1, 2)
+    assert index.full_leaves(2, 7) == range(1, 1)
+    assert index.leaves_sum(range(0, 2)) == combine(entry_hash(m) for m in entries(1, 8))
+
+    # an overwrite is remove + add, the old state comes back when it's undone
+    (original,) = entries(6, 6)
+    before = index.leaves_sum(range(0, 3))
+    index.remove(original)
+    index.add(original._replace(content="other"))
+    assert index.leaves_sum(range(0, 3)) != before
+    index.remove(original._replace(content="other"))
+    index.add(original)
+    assert index.leaves_sum(range(0, 3)) == before